@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+"""Local stand-in for the vCenter content library endpoints the modules call.
+
+Serves both the legacy /rest tree (responses wrapped in {'value': ...}) and
+the /api tree over HTTPS with keep-alive, from synthetic libraries of any
+size. Every request is counted per endpoint template, and per-request
+latency and a transient error rate can be injected to see how the modules
+behave against a slow or flaky vCenter.
+
+Run on its own for manual testing:
+
+    python benchmarks/mock_vcenter.py --items 100 --port 8443 --latency 0.02
+"""
+
+import argparse
+import base64
+import datetime
+import ipaddress
+import itertools
+import json
+import os
+import random
+import re
+import ssl
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+SESSION_HEADER = 'vmware-api-session-id'
+OS_VERSIONS = ('Windows2016', 'Windows2019', 'Windows2022', 'RHEL8', 'RHEL9', 'Ubuntu2204')
+PUBLISHED_STATES = ('True', 'False', 'Retired')
+LIBRARY_ID = r'(?P<library_id>[^/?]+)'
+ITEM_ID = r'(?P<item_id>[^/?]+)'
+TASK_ID = r'(?P<task_id>[^/?]+)'
+
+
+class VCenterState(object):
+    """Libraries, items, VMs and copy tasks of one synthetic vCenter."""
+
+    def __init__(self, items=100, libraries=('Dev', 'Prod'), vms=10, seed=0):
+        """Constructor."""
+        self.lock = threading.Lock()
+        self.libraries = {}
+        self.items = {}
+        self.vms = {}
+        self.tasks = {}
+        self.sessions = set()
+        rng = random.Random(seed)
+        vm_names = [f"vm{index:03d}" for index in range(vms)]
+        for vm_name in vm_names:
+            self.vms[f"vm-{len(self.vms) + 1}"] = vm_name
+        for library_name in libraries:
+            library_id = self.add_library(library_name)
+            for index in range(items):
+                vm_name = vm_names[index % len(vm_names)]
+                notes = {
+                    'operatingSystemVersion': OS_VERSIONS[index % len(OS_VERSIONS)],
+                    'published': rng.choice(PUBLISHED_STATES),
+                    'owner': 'benchmark',
+                }
+                self.add_item(library_id, f"{vm_name}_{library_name.lower()}{index:05d}", json.dumps(notes))
+
+    def add_library(self, name, library_type='LOCAL'):
+        library_id = str(uuid.uuid4())
+        self.libraries[library_id] = {'id': library_id, 'name': name, 'type': library_type, 'version': '1', 'items': []}
+        return library_id
+
+    def add_item(self, library_id, name, description=''):
+        item_id = str(uuid.uuid4())
+        self.items[item_id] = {
+            'id': item_id,
+            'library_id': library_id,
+            'name': name,
+            'description': description,
+            'type': 'ovf',
+            'creation_time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'metadata_version': '1',
+            'content_version': '1',
+        }
+        # Like vCenter, item changes leave the library's own version alone
+        self.libraries[library_id]['items'].append(item_id)
+        return item_id
+
+    def update_item(self, item_id, spec):
+        item = self.items[item_id]
+        item.update((key, value) for key, value in spec.items() if key in ('name', 'description'))
+        item['metadata_version'] = str(int(item['metadata_version']) + 1)
+
+    def delete_item(self, item_id):
+        item = self.items.pop(item_id)
+        self.libraries[item['library_id']]['items'].remove(item_id)
+
+    def copy_item(self, item_id, spec):
+        source = self.items[item_id]
+        library_id = spec.get('library_id') or source['library_id']
+        if library_id not in self.libraries:
+            raise KeyError(library_id)
+        return self.add_item(library_id, spec.get('name') or source['name'],
+                             spec.get('description', source['description']))
+
+    def find_libraries(self, spec):
+        return [library_id for library_id, library in self.libraries.items()
+                if library['name'] == spec.get('name') and spec.get('type') in (None, library['type'])]
+
+    def find_items(self, spec):
+        library = self.libraries.get(spec.get('library_id'))
+        if not library:
+            return []
+        return [item_id for item_id in library['items'] if self.items[item_id]['name'] == spec.get('name')]
+
+    def library_view(self, library_id):
+        return {key: value for key, value in self.libraries[library_id].items() if key != 'items'}
+
+
+class Route(object):
+    def __init__(self, method, template, handler, auth=True):
+        """Constructor."""
+        self.method = method
+        self.template = template
+        self.handler = handler
+        self.auth = auth
+        pattern = template.replace('{library_id}', LIBRARY_ID).replace('{item_id}', ITEM_ID)
+        self.pattern = re.compile(pattern.replace('{task_id}', TASK_ID) + '$')
+
+    @property
+    def name(self):
+        return f"{self.method} {self.template}"
+
+
+class MockVCenter(object):
+    """HTTPS server over a VCenterState; start() runs it on a daemon thread."""
+
+    def __init__(self, state=None, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, seed=0):
+        """Constructor."""
+        self.state = state or VCenterState()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self.errors = Counter()
+        self.counter_lock = threading.Lock()
+        self.task_ids = itertools.count(1)
+        self.routes = self.build_routes()
+
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.cert_dir = tempfile.mkdtemp(prefix='mock_vcenter_')
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*self_signed_certificate(self.cert_dir, host))
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        self.thread = None
+
+    @property
+    def host(self):
+        return self.server.server_address[0]
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='mock_vcenter', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for name in os.listdir(self.cert_dir):
+            os.remove(os.path.join(self.cert_dir, name))
+        os.rmdir(self.cert_dir)
+
+    def reset_counters(self):
+        with self.counter_lock:
+            self.requests.clear()
+            self.errors.clear()
+
+    def stats(self):
+        with self.counter_lock:
+            return {
+                'requests': sum(self.requests.values()),
+                'errors': sum(self.errors.values()),
+                'by_endpoint': dict(sorted(self.requests.items())),
+            }
+
+    def build_routes(self):
+        rest = '/rest/com/vmware'
+        return [
+            Route('POST', f'{rest}/cis/session', self.rest_session, auth=False),
+            Route('DELETE', f'{rest}/cis/session', self.delete_session),
+            Route('POST', f'{rest}/content/library', self.rest_find_library),
+            Route('GET', f'{rest}/content/library/id:{{library_id}}', self.rest_get_library),
+            Route('GET', f'{rest}/content/library/item', self.rest_list_items),
+            Route('POST', f'{rest}/content/library/item', self.rest_find_items),
+            Route('GET', f'{rest}/content/library/item/id:{{item_id}}', self.rest_get_item),
+            Route('PATCH', f'{rest}/content/library/item/id:{{item_id}}', self.rest_update_item),
+            Route('DELETE', f'{rest}/content/library/item/id:{{item_id}}', self.rest_delete_item),
+            Route('POST', f'{rest}/content/library/item/id:{{item_id}}', self.rest_copy_item),
+            Route('POST', f'{rest}/vcenter/ovf/library-item', self.rest_create_ovf),
+            Route('GET', '/rest/vcenter/vm', self.rest_find_vms),
+            Route('POST', '/api/session', self.api_create_session, auth=False),
+            Route('GET', '/api/session', self.api_get_session),
+            Route('DELETE', '/api/session', self.delete_session),
+            Route('POST', '/api/content/library', self.api_find_library),
+            Route('GET', '/api/content/library/item', self.api_list_items),
+            Route('POST', '/api/content/library/item', self.api_find_items),
+            Route('GET', '/api/content/library/item/{item_id}', self.api_get_item),
+            Route('PATCH', '/api/content/library/item/{item_id}', self.api_update_item),
+            Route('DELETE', '/api/content/library/item/{item_id}', self.api_delete_item),
+            Route('POST', '/api/content/library/item/{item_id}', self.api_copy_item),
+            # After the item routes, which it would otherwise shadow
+            Route('GET', '/api/content/library/{library_id}', self.api_get_library),
+            Route('GET', '/api/cis/tasks/{task_id}', self.api_get_task),
+            Route('POST', '/api/vcenter/ovf/library-item', self.api_create_ovf),
+            Route('GET', '/api/vcenter/vm', self.api_find_vms),
+        ]
+
+    def handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so client connection pooling shows up in the numbers
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes; Nagle would hold the body for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                mock.dispatch(self)
+
+            do_POST = do_PATCH = do_DELETE = do_GET
+
+        return Handler
+
+    def dispatch(self, request):
+        url = urlsplit(request.path)
+        query = {key: values[0] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+
+        for route in self.routes:
+            match = route.pattern.match(url.path) if route.method == request.command else None
+            if match:
+                break
+        else:
+            return self.respond(request, 404, {'error_type': 'NOT_FOUND', 'path': url.path})
+
+        with self.counter_lock:
+            self.requests[route.name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        # Session calls are left alone so injected errors hit the work, not the login
+        if route.auth and self.error_rate and self.random.random() < self.error_rate:
+            with self.counter_lock:
+                self.errors[route.name] += 1
+            return self.respond(request, 503, {'error_type': 'SERVICE_UNAVAILABLE'})
+        if route.auth and request.headers.get(SESSION_HEADER) not in self.state.sessions:
+            return self.respond(request, 401, {'error_type': 'UNAUTHENTICATED'})
+
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            return self.respond(request, 400, {'error_type': 'INVALID_ARGUMENT'})
+        try:
+            with self.state.lock:
+                status, data = route.handler(request=request, query=query, body=payload, **match.groupdict())
+        except KeyError:
+            status, data = 404, {'error_type': 'NOT_FOUND'}
+        self.respond(request, status, data)
+
+    def respond(self, request, status, data=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        request.send_response(status)
+        if body:
+            request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def create_session(self, request):
+        credentials = request.headers.get('Authorization', '')
+        if not credentials.startswith('Basic ') or ':' not in base64.b64decode(credentials[6:]).decode('utf-8'):
+            return None
+        session_id = uuid.uuid4().hex
+        self.state.sessions.add(session_id)
+        return session_id
+
+    def delete_session(self, request, **kwargs):
+        self.state.sessions.discard(request.headers.get(SESSION_HEADER))
+        return 200, None
+
+    def start_task(self, result):
+        task_id = f"task-{next(self.task_ids)}"
+        self.state.tasks[task_id] = {'status': 'SUCCEEDED', 'result': result}
+        return task_id
+
+    def library_items(self, query):
+        return list(self.state.libraries[query['library_id']]['items'])
+
+    # /rest flavour
+
+    def rest_session(self, request, query, body, **kwargs):
+        if query.get('~action') == 'get':
+            if request.headers.get(SESSION_HEADER) not in self.state.sessions:
+                return 401, {'type': 'com.vmware.vapi.std.errors.unauthenticated'}
+            return 200, {'value': {'user': 'benchmark'}}
+        session_id = self.create_session(request)
+        if not session_id:
+            return 401, {'type': 'com.vmware.vapi.std.errors.unauthenticated'}
+        return 200, {'value': session_id}
+
+    def rest_find_library(self, query, body, **kwargs):
+        return 200, {'value': self.state.find_libraries(body.get('spec', {}))}
+
+    def rest_get_library(self, library_id, **kwargs):
+        return 200, {'value': self.state.library_view(library_id)}
+
+    def rest_list_items(self, query, **kwargs):
+        return 200, {'value': self.library_items(query)}
+
+    def rest_find_items(self, body, **kwargs):
+        return 200, {'value': self.state.find_items(body.get('spec', {}))}
+
+    def rest_get_item(self, item_id, **kwargs):
+        return 200, {'value': self.state.items[item_id]}
+
+    def rest_update_item(self, item_id, body, **kwargs):
+        self.state.update_item(item_id, body.get('update_spec', {}))
+        return 200, None
+
+    def rest_delete_item(self, item_id, **kwargs):
+        self.state.delete_item(item_id)
+        return 200, None
+
+    def rest_copy_item(self, item_id, query, body, **kwargs):
+        return 200, {'value': self.state.copy_item(item_id, body.get('destination_create_spec', {}))}
+
+    def rest_create_ovf(self, body, **kwargs):
+        item_id = self.create_ovf(body)
+        return 200, {'value': {'succeeded': True, 'resource_id': {'type': 'com.vmware.content.library.Item', 'id': item_id}}}
+
+    def rest_find_vms(self, request, **kwargs):
+        return 200, {'value': self.find_vms(query_values(request, 'filter.names'))}
+
+    # /api flavour
+
+    def api_create_session(self, request, **kwargs):
+        session_id = self.create_session(request)
+        if not session_id:
+            return 401, {'error_type': 'UNAUTHENTICATED'}
+        return 201, session_id
+
+    def api_get_session(self, **kwargs):
+        return 200, {'user': 'benchmark'}
+
+    def api_find_library(self, body, **kwargs):
+        return 200, self.state.find_libraries(body)
+
+    def api_get_library(self, library_id, **kwargs):
+        return 200, self.state.library_view(library_id)
+
+    def api_list_items(self, query, **kwargs):
+        return 200, self.library_items(query)
+
+    def api_find_items(self, body, **kwargs):
+        return 200, self.state.find_items(body)
+
+    def api_get_item(self, item_id, **kwargs):
+        return 200, self.state.items[item_id]
+
+    def api_update_item(self, item_id, body, **kwargs):
+        self.state.update_item(item_id, body)
+        return 204, None
+
+    def api_delete_item(self, item_id, **kwargs):
+        self.state.delete_item(item_id)
+        return 204, None
+
+    def api_copy_item(self, item_id, query, body, **kwargs):
+        new_id = self.state.copy_item(item_id, body)
+        if query.get('vmw-task') == 'true':
+            return 202, self.start_task(new_id)
+        return 200, new_id
+
+    def api_get_task(self, task_id, **kwargs):
+        return 200, self.state.tasks[task_id]
+
+    def api_create_ovf(self, body, **kwargs):
+        item_id = self.create_ovf(body)
+        return 200, {'succeeded': True, 'resource_id': {'type': 'com.vmware.content.library.Item', 'id': item_id}}
+
+    def api_find_vms(self, request, **kwargs):
+        return 200, self.find_vms(query_values(request, 'names'))
+
+    def create_ovf(self, body):
+        if body.get('source', {}).get('id') not in self.state.vms:
+            raise KeyError(body.get('source', {}).get('id'))
+        return self.state.add_item(body['target']['library_id'], body['create_spec']['name'],
+                                   body['create_spec'].get('description', ''))
+
+    def find_vms(self, names):
+        return [{'vm': vm_id, 'name': vm_name, 'power_state': 'POWERED_OFF'}
+                for vm_id, vm_name in self.state.vms.items() if not names or vm_name in names]
+
+
+def query_values(request, name):
+    # Filters like names may repeat, which the first-value query dict drops
+    return parse_qs(urlsplit(request.path).query).get(name)
+
+
+def self_signed_certificate(cert_dir, host):
+    """Throwaway server certificate for the mock; clients run with validate_certs off."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'mock-vcenter')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        alt_name = x509.IPAddress(ipaddress.ip_address(host))
+    except ValueError:
+        alt_name = x509.DNSName(host)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([alt_name]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    cert_file = os.path.join(cert_dir, 'cert.pem')
+    key_file = os.path.join(cert_dir, 'key.pem')
+    with open(cert_file, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_file, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return cert_file, key_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--items', type=int, default=100, help='items per library')
+    parser.add_argument('--vms', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    mock = MockVCenter(VCenterState(items=args.items, vms=args.vms, seed=args.seed), host=args.host, port=args.port,
+                       latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    print(f"Mock vCenter on https://{mock.host}:{mock.port} with {args.items} items per library")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(mock.stats(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""Benchmark the content library modules against the local mock vCenter.
+
+Each module runs in its own process against a freshly seeded mock at every
+library size, and the wall time plus the requests it made are recorded.
+Results are appended as JSON lines so runs from different commits can be
+compared:
+
+    python benchmarks/run_benchmarks.py --sizes 10 100 1000 --label "$(git rev-parse --short HEAD)"
+    python benchmarks/run_benchmarks.py --latency 0.02 --error-rate 0.01 --modules dev_to_prod
+
+Needs ansible-core, requests and cryptography importable by the running Python.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_vcenter import OS_VERSIONS, MockVCenter, VCenterState
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCHMARKS)
+
+
+def connection(mock):
+    return dict(hostname=mock.host, port=mock.port, username='benchmark', password='benchmark', validate_certs=False)
+
+
+def template_finder_args(mock, state):
+    # newest has to read the whole library, the worst case for the finder
+    return dict(connection(mock), port=str(mock.port), library='Dev', os_versions=list(OS_VERSIONS), selection='newest')
+
+
+def dev_to_prod_args(mock, state):
+    return dict(connection(mock), source_library='Dev', destination_library='Prod', task_poll_interval=0)
+
+
+def add_contents_args(mock, state):
+    vm_name = next(iter(state.vms.values()))
+    return dict(connection(mock), content_library='Dev', vm_name=vm_name, esxi_host='esx01',
+                new_template_name=f"{vm_name}_benchmark")
+
+
+def add_contents_batch_args(mock, state):
+    vm_names = list(state.vms.values())[:5]
+    return dict(connection(mock), content_library='Dev', esxi_host='esx01',
+                vms=[dict(vm_name=vm_name, new_template_name=f"{vm_name}_benchmark") for vm_name in vm_names])
+
+
+def amend_annotation_args(mock, state):
+    return dict(connection(mock), content_library='Dev')
+
+
+def remove_template_args(mock, state):
+    library = next(library for library in state.libraries.values() if library['name'] == 'Dev')
+    template_name = state.items[library['items'][-1]]['name'] if library['items'] else 'missing'
+    return dict(connection(mock), content_library='Dev', template_name=template_name)
+
+
+# Benchmark name -> (module file, builder of its arguments against a seeded mock)
+MODULES = {
+    'template_finder': ('vmware_template_finder.py', template_finder_args),
+    'dev_to_prod': ('vmware_content_library_dev_to_prod.py', dev_to_prod_args),
+    'add_contents': ('vmware_content_library_add_contents.py', add_contents_args),
+    'add_contents_batch': ('vmware_content_library_add_contents.py', add_contents_batch_args),
+    'amend_annotation': ('vmware_content_library_amend_annotation.py', amend_annotation_args),
+    'remove_template': ('remove_template.yml', remove_template_args),
+}
+
+
+def parse_result(stdout):
+    for line in reversed(stdout.splitlines()):
+        line = line.strip()
+        if line.startswith('{'):
+            try:
+                return json.loads(line)
+            except ValueError:
+                continue
+    return None
+
+
+def run_module(name, size, args):
+    module_file, build_args = MODULES[name]
+    state = VCenterState(items=size, seed=args.seed)
+    mock = MockVCenter(state, latency=args.latency, error_rate=args.error_rate, seed=args.seed).start()
+    try:
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump({'ANSIBLE_MODULE_ARGS': build_args(mock, state)}, f)
+        started = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, os.path.join(BENCHMARKS, 'run_module.py'), os.path.join(REPO, module_file), f.name],
+            capture_output=True, text=True, timeout=args.timeout,
+        )
+        wall_time = time.perf_counter() - started
+    finally:
+        mock.stop()
+        os.remove(f.name)
+
+    result = parse_result(process.stdout) or {'failed': True, 'msg': process.stderr.strip()[-500:]}
+    stats = mock.stats()
+    record = {
+        'label': args.label,
+        'module': name,
+        'items': size,
+        'wall_time': round(wall_time, 3),
+        'requests': stats['requests'],
+        'errors_injected': stats['errors'],
+        'by_endpoint': stats['by_endpoint'],
+        'failed': bool(result.get('failed')) or process.returncode != 0,
+        'changed': result.get('changed'),
+        'latency': args.latency,
+        'error_rate': args.error_rate,
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    if record['failed']:
+        record['msg'] = result.get('msg')
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='items per library')
+    parser.add_argument('--modules', nargs='+', choices=sorted(MODULES), default=list(MODULES))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every mock request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of mock requests answered with 503')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=int, default=1800, help='seconds one module run may take')
+    parser.add_argument('--label', default='', help='recorded with every result, e.g. a commit id')
+    parser.add_argument('--output', default=os.path.join(BENCHMARKS, 'results.jsonl'))
+    args = parser.parse_args()
+
+    print(f"{'module':<18} {'items':>6} {'wall s':>8} {'requests':>9}  status")
+    with open(args.output, 'a') as output:
+        for size in args.sizes:
+            for name in args.modules:
+                for _ in range(args.repeat):
+                    record = run_module(name, size, args)
+                    output.write(json.dumps(record) + '\n')
+                    output.flush()
+                    # Only the last line of a traceback fits the table; the full text is in the output file
+                    status = 'ok'
+                    if record['failed']:
+                        lines = (record['msg'] or '').strip().splitlines() or ['']
+                        status = f"failed: {lines[-1]}"
+                    print(f"{name:<18} {size:>6} {record['wall_time']:>8.2f} {record['requests']:>9}  {status}")
+
+
+if __name__ == '__main__':
+    main()
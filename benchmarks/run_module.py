@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+"""Run one of the repo's modules directly against a JSON args file.
+
+    python benchmarks/run_module.py vmware_template_finder.py args.json
+
+The file holds {"ANSIBLE_MODULE_ARGS": {...}}, as for any Ansible module run
+by hand, and the module's result JSON is printed to stdout.
+"""
+
+import os
+import runpy
+import sys
+
+import ansible.module_utils
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def install_module_utils():
+    # Ansible ships the repo's module_utils with the module; here the package path is extended instead
+    ansible.module_utils.__path__.append(os.path.join(REPO, 'module_utils'))
+
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    module_path, args_path = sys.argv[1:]
+    install_module_utils()
+    sys.argv = [module_path, args_path]
+    runpy.run_path(module_path, run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,57 +1,253 @@
 #!/usr/bin/env python
 
-from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import datetime
+import multiprocessing
 import os
-import subprocess
+import time
+import traceback
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import UnsupportedAlgorithm
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+    from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+    HAS_CRYPTOGRAPHY = True
+    CRYPTOGRAPHY_IMPORT_ERROR = None
+except ImportError:
+    HAS_CRYPTOGRAPHY = False
+    CRYPTOGRAPHY_IMPORT_ERROR = traceback.format_exc()
+
+# Microsoft User Principal Name, which WinRM certificate mapping matches against
+UPN_OID = '1.3.6.1.4.1.311.20.2.3'
+VALID_DAYS = 3650
+
+
+def der_utf8_string(text):
+    """DER-encode text as an ASN.1 UTF8String, the form the UPN otherName carries."""
+    data = text.encode('utf-8')
+    length = len(data)
+    if length < 0x80:
+        encoded_length = bytes([length])
+    else:
+        length_bytes = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+        encoded_length = bytes([0x80 | len(length_bytes)]) + length_bytes
+    return b'\x0c' + encoded_length + data
+
+
+def generate_private_key(key_type):
+    if key_type == 'ecdsa':
+        return ec.generate_private_key(ec.SECP256R1())
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def build_certificate(key, common_name):
+    """Self-signed client certificate with the clientAuth EKU and a {cn}@localhost UPN."""
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    upn = x509.OtherName(x509.ObjectIdentifier(UPN_OID), der_utf8_string(f"{common_name}@localhost"))
+    return (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=VALID_DAYS))
+        .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH]), critical=False)
+        .add_extension(x509.SubjectAlternativeName([upn]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+
+
+def write_file(path, data, mode=0o644):
+    # Write beside the target and rename, so a concurrent reader never sees half a key
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def not_valid_after(cert):
+    # cryptography 42 added the timezone-aware attribute and deprecated the naive one
+    if hasattr(cert, 'not_valid_after_utc'):
+        return cert.not_valid_after_utc
+    return cert.not_valid_after.replace(tzinfo=datetime.timezone.utc)
+
+
+def key_type_of(key):
+    if isinstance(key, ec.EllipticCurvePrivateKey):
+        return 'ecdsa'
+    if isinstance(key, rsa.RSAPrivateKey):
+        return 'rsa'
+    return None
+
+
+def openssh_public_key(key):
+    return key.public_key().public_bytes(serialization.Encoding.OpenSSH, serialization.PublicFormat.OpenSSH) + b'\n'
+
+
+def certificate_facts(cert):
+    return {
+        'fingerprint': cert.fingerprint(hashes.SHA256()).hex(':'),
+        'not_after': not_valid_after(cert).isoformat(),
+    }
+
+
+def load_existing(cert_file, key_file, common_name, key_type, renew_before):
+    """Return (key, cert, None) if the files on disk can be kept, else (None, None, reason)."""
+    try:
+        with open(cert_file, 'rb') as f:
+            cert = x509.load_pem_x509_certificate(f.read())
+        with open(key_file, 'rb') as f:
+            key = serialization.load_pem_private_key(f.read(), password=None)
+    except (IOError, OSError, ValueError, TypeError, UnsupportedAlgorithm) as e:
+        return None, None, f'existing files unreadable: {e}'
+
+    spki = serialization.PublicFormat.SubjectPublicKeyInfo
+    if (key.public_key().public_bytes(serialization.Encoding.DER, spki)
+            != cert.public_key().public_bytes(serialization.Encoding.DER, spki)):
+        return None, None, 'key does not match certificate'
+    if key_type_of(key) != key_type:
+        return None, None, f'key type is not {key_type}'
+    names = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+    if not names or names[0].value != common_name:
+        return None, None, f'common name is not {common_name}'
+    renew_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=renew_before)
+    if not_valid_after(cert) <= renew_at:
+        return None, None, f'certificate expires within {renew_before} days'
+    return key, cert, None
+
+
+def generate(cert_file, key_file, pub_key_file, common_name, key_type='rsa'):
+    key = generate_private_key(key_type)
+    cert = build_certificate(key, common_name)
+    write_file(key_file, key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ), mode=0o600)
+    write_file(cert_file, cert.public_bytes(serialization.Encoding.PEM))
+    write_file(pub_key_file, openssh_public_key(key))
+    return cert
+
+
+def ensure_certificate(spec, renew_before=30, force=False, check_mode=False):
+    """Reuse or (re)generate one identity's files and report what happened and how long it took.
+
+    Module-level so process pool workers can run it; errors come back in the
+    result instead of being raised across the process boundary.
+    """
+    started = time.monotonic()
+    result = {'common_name': spec['common_name'], 'cert_file': spec['cert_file'], 'key_type': spec['key_type']}
+    try:
+        reason = 'force is set'
+        if not force:
+            key, cert, reason = load_existing(spec['cert_file'], spec['key_file'], spec['common_name'],
+                                              spec['key_type'], renew_before)
+            if key is not None:
+                public_key = openssh_public_key(key)
+                try:
+                    with open(spec['pub_key_file'], 'rb') as f:
+                        changed = f.read() != public_key
+                except (IOError, OSError):
+                    changed = True
+                # The cert and key are still good; at most the OpenSSH copy needs rewriting
+                if changed and not check_mode:
+                    write_file(spec['pub_key_file'], public_key)
+                result.update(status='reused', changed=changed, **certificate_facts(cert))
+                return result
+
+        if check_mode:
+            result.update(status='generated', changed=True, msg=f'Certificate would be regenerated: {reason}')
+            return result
+
+        cert = generate(spec['cert_file'], spec['key_file'], spec['pub_key_file'], spec['common_name'], spec['key_type'])
+        result.update(status='generated', changed=True, msg=f'Certificate regenerated: {reason}', **certificate_facts(cert))
+    except Exception as e:
+        # Anything raised here would escape the pool worker and lose every other result
+        result.update(status='failed', changed=False, msg=f'Failed to create certificates: {e}')
+    finally:
+        result['duration'] = round(time.monotonic() - started, 3)
+    return result
+
+
+def ensure_certificates(specs, renew_before=30, force=False, check_mode=False, workers=None):
+    """Run ensure_certificate for every spec across a process pool, keeping input order."""
+    task = partial(ensure_certificate, renew_before=renew_before, force=force, check_mode=check_mode)
+    workers = min(workers or os.cpu_count() or 1, len(specs))
+    if workers <= 1:
+        return [task(spec) for spec in specs]
+    # Key generation is CPU bound, so threads would serialise on the GIL. Fork explicitly: the
+    # module runs from a zipped __main__ that spawn/forkserver workers could not re-import.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        return list(executor.map(task, specs))
+
 
 def run_module():
+    certificate_spec = dict(
+        cert_file=dict(type='str', required=True),
+        key_file=dict(type='str', required=True),
+        pub_key_file=dict(type='str', required=True),
+        common_name=dict(type='str', required=True),
+        key_type=dict(type='str', choices=['rsa', 'ecdsa']),
+    )
     module = AnsibleModule(
         argument_spec=dict(
-            cert_file=dict(type='str', required=True),
-            key_file=dict(type='str', required=True),
-            pub_key_file=dict(type='str', required=True),
-            common_name=dict(type='str', required=True),
+            cert_file=dict(type='str'),
+            key_file=dict(type='str'),
+            pub_key_file=dict(type='str'),
+            common_name=dict(type='str'),
+            key_type=dict(type='str', default='rsa', choices=['rsa', 'ecdsa']),
+            renew_before=dict(type='int', default=30),
+            force=dict(type='bool', default=False),
+            certificates=dict(type='list', elements='dict', options=certificate_spec),
+            workers=dict(type='int'),
         ),
+        required_together=[['cert_file', 'key_file', 'pub_key_file', 'common_name']],
+        required_one_of=[['common_name', 'certificates']],
+        mutually_exclusive=[['common_name', 'certificates']],
         supports_check_mode=True
     )
 
-    cert_file = module.params['cert_file']
-    key_file = module.params['key_file']
-    pub_key_file = module.params['pub_key_file']
-    common_name = module.params['common_name']
+    if not HAS_CRYPTOGRAPHY:
+        module.fail_json(msg=missing_required_lib('cryptography'), exception=CRYPTOGRAPHY_IMPORT_ERROR)
 
-    if module.check_mode:
-        return module.exit_json(changed=False)
+    params = module.params
+    options = dict(renew_before=params['renew_before'], force=params['force'], check_mode=module.check_mode)
 
-    try:
-        openssl_config = """
-        distinguished_name = req_distinguished_name
-        [req_distinguished_name]
-        [v3_req_client]
-        extendedKeyUsage = clientAuth
-        subjectAltName = otherName:1.3.6.1.4.1.311.20.2.3;UTF8:{0}@localhost
-        """.format(common_name)
-        
-        with open('openssl.conf', 'w') as f:
-            f.write(openssl_config)
-        
-        os.environ['OPENSSL_CONF'] = 'openssl.conf'
-        
-        subprocess.check_call(['openssl', 'req', '-x509', '-nodes', '-days', '3650', '-newkey', 'rsa:2048', '-out', 
-                               cert_file, '-outform', 'PEM', '-keyout', key_file, '-subj', 
-                               '/CN={}'.format(common_name), '-extensions', 'v3_req_client'])
-        subprocess.check_call(['ssh-keygen', '-f', key_file, '-y'], stdout=open(pub_key_file, 'w'))
-
-    except subprocess.CalledProcessError as e:
-        module.fail_json(msg='Failed to create certificates: {}'.format(str(e)), changed=False)
+    if not params['certificates']:
+        result = ensure_certificate({name: params[name] for name in certificate_spec}, **options)
+        if result.pop('status') == 'failed':
+            module.fail_json(**result)
+        module.exit_json(**result)
+
+    specs = [dict(spec, key_type=spec['key_type'] or params['key_type']) for spec in params['certificates']]
+    paths = [spec[name] for spec in specs for name in ('cert_file', 'key_file', 'pub_key_file')]
+    duplicates = sorted({path for path in paths if paths.count(path) > 1})
+    if duplicates:
+        module.fail_json(msg=f"Output files listed more than once: {', '.join(duplicates)}")
+
+    results = ensure_certificates(specs, workers=params['workers'], **options)
+    changed = any(result['changed'] for result in results)
+    failed = [result for result in results if result['status'] == 'failed']
+    if failed:
+        module.fail_json(msg=f"{len(failed)} of {len(results)} certificates failed", changed=changed, certificates=results)
+    module.exit_json(changed=changed, certificates=results)
 
-    finally:
-        os.remove('openssl.conf')
-    
-    module.exit_json(changed=True)
 
 def main():
     run_module()
 
+
 if __name__ == '__main__':
     main()
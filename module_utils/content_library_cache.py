@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+
+def inventory_cache_argument_spec():
+    """Options for modules that can read library items through InventoryCache."""
+    return dict(
+        inventory_cache=dict(type='bool', default=False),
+        inventory_cache_dir=dict(type='path', default='~/.ansible/cache/vmware_content_library'),
+        inventory_cache_ttl=dict(type='int', default=900),
+        inventory_cache_max_size=dict(type='int', default=64),
+    )
+
+
+class InventoryCache(object):
+    """On-disk cache of parsed library items, one file per vCenter host and library.
+
+    The item ids are listed on every load, so added and deleted items show
+    up at once and only new ids are fetched. Edits to an item are not seen
+    until the entry expires: vCenter has no cheap way to ask which items
+    changed (the library ``version`` only moves with the library's own
+    properties), so an entry may be up to ``ttl`` seconds stale. Use it only
+    for read-only lookups, never to plan changes to a library.
+    """
+
+    def __init__(self, cache_dir, ttl=900, max_size=64 * 1024 * 1024):
+        """Constructor."""
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_module(cls, module):
+        params = module.params
+        if not params.get('inventory_cache'):
+            return None
+        return cls(
+            params['inventory_cache_dir'],
+            ttl=params['inventory_cache_ttl'],
+            max_size=params['inventory_cache_max_size'] * 1024 * 1024,
+        )
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def path(self, hostname, library_id):
+        key = hashlib.sha256(f"{hostname}/{library_id}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def read(self, hostname, library_id):
+        try:
+            with open(self.path(hostname, library_id)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if time.time() - entry.get('stored_at', 0) > self.ttl:
+            return None
+        return entry
+
+    def write(self, hostname, library_id, items, stored_at=None):
+        entry = {
+            'hostname': hostname,
+            'library_id': library_id,
+            'stored_at': stored_at or time.time(),
+            'items': [[item_id, item] for item_id, item in items],
+        }
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self.path(hostname, library_id))
+        except (IOError, OSError):
+            # A cache that cannot be written only costs the next run a listing
+            return
+        self.evict()
+
+    def evict(self):
+        # Other forks share the directory: their files may vanish under us, and a young
+        # .tmp file is another process's write in flight
+        entries = []
+        now = time.time()
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                self.remove(path)
+            elif name.endswith('.json'):
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            self.remove(path)
+            total_size -= size
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def load(self, client, library_id):
+        """Return the library's (item_id, item) pairs, fetching only ids the cache does not hold."""
+        entry = self.read(client.hostname, library_id)
+        cached = dict(entry['items']) if entry else {}
+        item_ids = client.list_library_items(library_id)
+        missing = [item_id for item_id in item_ids if item_id not in cached]
+        fetched = dict(zip(missing, client.get_library_items(missing)))
+        self.hits += len(item_ids) - len(missing)
+        self.misses += len(missing)
+
+        items = [(item_id, cached[item_id] if item_id in cached else fetched[item_id] or {}) for item_id in item_ids]
+        # Reused items keep the entry's age, so no item outlives the TTL
+        self.write(client.hostname, library_id, items, entry['stored_at'] if entry else None)
+        return items
@@ -0,0 +1,39 @@
+#!/usr/bin/python
+
+from collections import OrderedDict
+
+
+class LibraryInventory(object):
+    """Snapshot of a content library's items, kept current as items are copied in or deleted."""
+
+    def __init__(self, library_id, items=None):
+        """Constructor."""
+        self.library_id = library_id
+        self.items = OrderedDict()
+        for item_id, item in items or []:
+            self.add(item_id, item)
+
+    @classmethod
+    def load(cls, client, library_id, cache=None):
+        if cache:
+            return cls(library_id, cache.load(client, library_id))
+        item_ids = client.list_library_items(library_id)
+        return cls(library_id, zip(item_ids, client.get_library_items(item_ids)))
+
+    def add(self, item_id, item):
+        self.items[item_id] = item or {}
+
+    def remove(self, item_id):
+        self.items.pop(item_id, None)
+
+    def get(self, item_id):
+        return self.items.get(item_id)
+
+    def names(self):
+        return {item.get('name', '') for item in self.items.values()}
+
+    def __iter__(self):
+        return iter(self.items.items())
+
+    def __len__(self):
+        return len(self.items)
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+import ast
+import json
+from functools import lru_cache
+
+PUBLISHED = 'True'
+UNPUBLISHED = 'False'
+RETIRED = 'Retired'
+
+
+class TemplateNotes(object):
+    """Parsed template annotation. Instances are shared through parse_notes, so treat them as read-only."""
+
+    __slots__ = ('published', 'os_version', 'fields')
+
+    def __init__(self, fields=None):
+        """Constructor."""
+        self.fields = dict(fields or {})
+        published = self.fields.get('published')
+        # Older annotations carry real booleans, newer ones the 'True'/'False'/'Retired' strings
+        if isinstance(published, bool):
+            published = PUBLISHED if published else UNPUBLISHED
+        self.published = published
+        self.os_version = self.fields.get('operatingSystemVersion')
+
+    def __bool__(self):
+        return bool(self.fields)
+
+    def get(self, field, default=None):
+        return self.fields.get(field, default)
+
+    @property
+    def is_published(self):
+        return bool(self.published) and self.published not in (UNPUBLISHED, RETIRED)
+
+    def replace(self, **fields):
+        updated = dict(self.fields)
+        updated.update(fields)
+        return TemplateNotes(updated)
+
+    def dumps(self):
+        """Canonical JSON form, the only form written back to vCenter."""
+        return json.dumps(self.fields, sort_keys=True)
+
+
+def decode_notes(text):
+    """Read an annotation written either as JSON or as a Python dict repr."""
+    if not text or not text.strip():
+        return {}
+    try:
+        fields = json.loads(text)
+    except ValueError:
+        try:
+            fields = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            # Last resort for the quote-swapped form earlier module versions produced
+            fields = json.loads(text.replace("'", '"'))
+    if not isinstance(fields, dict):
+        raise ValueError(f"Template notes are not a mapping: {text!r}")
+    return fields
+
+
+@lru_cache(maxsize=4096)
+def parse_notes(text):
+    """Parse an annotation once; identical text (same item, same version) reuses the result."""
+    return TemplateNotes(decode_notes(text))
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+import heapq
+import re
+from collections import defaultdict
+
+
+def version_key(text):
+    """Sort key that orders embedded numbers numerically, so 'vm_10' comes after 'vm_9'."""
+    return tuple(int(part) if index % 2 else part for index, part in enumerate(re.split(r'(\d+)', text or '')))
+
+
+class RetentionPolicy(object):
+    """Which templates of a library to delete, worked out in one pass.
+
+    Templates are grouped by group_key (None leaves a template alone) and
+    split by state_key within a group. Only the newest keep[state] of each
+    group and state survive, newest meaning highest order_key, or latest in
+    the input when there is none. States missing from keep are never
+    deleted. A state named in prune_when is only trimmed in groups that also
+    hold a template in the given other state.
+    """
+
+    def __init__(self, group_key, keep=None, state_key=None, order_key=None, prune_when=None):
+        """Constructor."""
+        self.group_key = group_key
+        self.keep = keep
+        self.state_key = state_key
+        self.order_key = order_key
+        self.prune_when = prune_when or {}
+
+    def limit(self, state):
+        if isinstance(self.keep, dict):
+            return self.keep.get(state)
+        return self.keep
+
+    def classify(self, templates):
+        for position, template in enumerate(templates):
+            group = self.group_key(template)
+            if group is None:
+                continue
+            state = self.state_key(template) if self.state_key else None
+            order = self.order_key(template) if self.order_key else position
+            yield position, template, group, state, order
+
+    def partition(self, templates):
+        """{group: {state: [templates, newest first]}} for callers that act on whole groups."""
+        groups = defaultdict(lambda: defaultdict(list))
+        for position, template, group, state, order in self.classify(templates):
+            groups[group][state].append((order, position, template))
+        return {group: {state: [template for _, _, template in sorted(entries, key=lambda entry: entry[:2], reverse=True)]
+                        for state, entries in states.items()}
+                for group, states in groups.items()}
+
+    def reason(self, group, state):
+        kind = f"{state!r} templates" if self.state_key else "templates"
+        limit = self.limit(state)
+        if not limit:
+            return f"no {kind} are kept in {group!r} once it has a {self.prune_when.get(state)!r} one"
+        return f"older than the newest {limit} {kind} in {group!r}"
+
+    def select(self, templates):
+        """Return (template, reason) for every template to delete, in input order.
+
+        Each group and state keeps a min-heap of its newest keep[state]
+        templates; whatever falls off the heap is excess. That is a single
+        pass over the library with O(log keep) work per template.
+        """
+        newest = {}
+        states_seen = defaultdict(set)
+        excess = []
+        conditional = defaultdict(list)
+        for position, template, group, state, order in self.classify(templates):
+            states_seen[group].add(state)
+            limit = self.limit(state)
+            if limit is None:
+                continue
+            heap = newest.setdefault((group, state), [])
+            # position breaks ties, so templates themselves are never compared
+            heapq.heappush(heap, (order, position, template))
+            if len(heap) > limit:
+                _, dropped_position, dropped = heapq.heappop(heap)
+                entry = (dropped_position, dropped, self.reason(group, state))
+                if state in self.prune_when:
+                    conditional[group, state].append(entry)
+                else:
+                    excess.append(entry)
+
+        # Conditional trimming can only be settled once the whole group has been seen
+        for (group, state), entries in conditional.items():
+            if self.prune_when[state] in states_seen[group]:
+                excess.extend(entries)
+        return [(template, reason) for _, template, reason in sorted(excess, key=lambda entry: entry[0])]
@@ -0,0 +1,502 @@
+#!/usr/bin/python
+
+import atexit
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import weakref
+import requests
+import urllib3
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from requests.adapters import HTTPAdapter
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# Endpoint flavours exposed by vCenter: the legacy /rest tree wraps every
+# response in {'value': ...}, the newer /api tree returns the bare payload.
+REST = 'rest'
+API = 'api'
+
+SESSION_HEADER = 'vmware-api-session-id'
+
+# Responses worth retrying: throttling and the gateway errors vCenter returns while busy
+TRANSIENT_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Path segments that name an object rather than an endpoint, folded into {id} for api_stats
+ID_SEGMENTS = (
+    (re.compile(r'/id:[^/]+'), '/id:{id}'),
+    (re.compile(r'(/api/content/library(?:/item)?|/api/cis/tasks)/(?!item(?:/|$))[^/]+'), r'\1/{id}'),
+)
+# Query parameters that select the operation, kept verbatim; every other value is elided
+ACTION_PARAMETERS = ('~action', 'action', 'vmw-task')
+
+
+def vcenter_client_argument_spec():
+    """Options shared by every module built on VCenterClient."""
+    return dict(
+        connect_timeout=dict(type='int', default=10),
+        request_timeout=dict(type='int', default=300),
+        pool_size=dict(type='int', default=10),
+        max_concurrency=dict(type='int', default=8),
+        retries=dict(type='int', default=3),
+        session_cache=dict(type='bool', default=False),
+        session_cache_dir=dict(type='path', default='~/.ansible/cache/vcenter_sessions'),
+        session_cache_ttl=dict(type='int', default=1500),
+        logout=dict(type='bool', default=False),
+        api_stats=dict(type='bool', default=False),
+        api_stats_file=dict(type='path'),
+    )
+
+
+def bounded_map(func, items, max_concurrency):
+    """Apply func to items with at most max_concurrency calls in flight, keeping input order."""
+    items = list(items)
+    if max_concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+def bounded_imap(func, items, max_concurrency):
+    """Lazy bounded_map: results are yielded in input order as soon as each is ready.
+
+    Only max_concurrency calls run ahead of the consumer, so a caller that
+    stops iterating early leaves the rest of items untouched.
+    """
+    items = iter(items)
+    if max_concurrency <= 1:
+        for item in items:
+            yield func(item)
+        return
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    pending = deque(executor.submit(func, item) for item in islice(items, max_concurrency))
+    try:
+        while pending:
+            result = pending.popleft().result()
+            for item in islice(items, 1):
+                pending.append(executor.submit(func, item))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def endpoint_template(method, path):
+    """'GET /api/content/library/item/<uuid>' -> 'GET /api/content/library/item/{id}', and so on."""
+    path, _, query = path.partition('?')
+    for pattern, replacement in ID_SEGMENTS:
+        path = pattern.sub(replacement, path)
+    parameters = []
+    for parameter in query.split('&') if query else []:
+        name, _, value = parameter.partition('=')
+        parameters.append(parameter if name in ACTION_PARAMETERS else f"{name}=*")
+    return f"{method.upper()} {path}{'?' + '&'.join(parameters) if parameters else ''}"
+
+
+def percentile(ordered, fraction):
+    # Nearest rank on an already sorted list
+    return ordered[max(int(round(fraction * len(ordered))) - 1, 0)]
+
+
+class ApiStats(object):
+    """Per-endpoint counts, latencies, bytes and status codes of every vCenter request in a module run.
+
+    Shared by all clients built for the same module, so multi-vCenter runs
+    report one set of numbers. With a file, each request is also appended as
+    a JSON line.
+    """
+
+    _by_module = weakref.WeakKeyDictionary()
+
+    def __init__(self, path=None):
+        """Constructor."""
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.path = path
+        self.file = None
+
+    @classmethod
+    def from_module(cls, module):
+        if not module.params.get('api_stats') and not module.params.get('api_stats_file'):
+            return None
+        if module not in cls._by_module:
+            stats = cls(module.params.get('api_stats_file'))
+            cls._by_module[module] = stats
+            atexit.register(stats.close)
+        return cls._by_module[module]
+
+    def record(self, hostname, method, path, status, elapsed, bytes_sent=0, bytes_received=0):
+        endpoint = endpoint_template(method, path)
+        with self.lock:
+            entry = self.endpoints.setdefault(endpoint, {
+                'latencies': [], 'bytes_sent': 0, 'bytes_received': 0, 'status_codes': Counter(),
+            })
+            entry['latencies'].append(elapsed)
+            entry['bytes_sent'] += bytes_sent
+            entry['bytes_received'] += bytes_received
+            entry['status_codes'][str(status)] += 1
+            if self.path:
+                self.write({'timestamp': time.time(), 'hostname': hostname, 'endpoint': endpoint, 'status': status,
+                            'elapsed': round(elapsed, 4), 'bytes_sent': bytes_sent, 'bytes_received': bytes_received})
+
+    def write(self, line):
+        try:
+            if self.file is None:
+                self.file = open(os.path.expanduser(self.path), 'a')
+            self.file.write(json.dumps(line) + '\n')
+        except (IOError, OSError):
+            # Losing the trace must not fail the module
+            self.path = None
+
+    def summary(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, entry in sorted(self.endpoints.items()):
+                ordered = sorted(entry['latencies'])
+                endpoints[endpoint] = {
+                    'count': len(ordered),
+                    'total_time': round(sum(ordered), 3),
+                    'p50': round(percentile(ordered, 0.5), 4),
+                    'p90': round(percentile(ordered, 0.9), 4),
+                    'p99': round(percentile(ordered, 0.99), 4),
+                    'max': round(ordered[-1], 4),
+                    'bytes_sent': entry['bytes_sent'],
+                    'bytes_received': entry['bytes_received'],
+                    'status_codes': dict(entry['status_codes']),
+                }
+        return {
+            'requests': sum(entry['count'] for entry in endpoints.values()),
+            'total_time': round(sum(entry['total_time'] for entry in endpoints.values()), 3),
+            'endpoints': endpoints,
+        }
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def run_stats(client, cache=None):
+    """Diagnostics for a module result, failed or not: inventory cache hits and misses, and api_stats."""
+    result = {}
+    if cache:
+        result['inventory_cache'] = cache.stats()
+    if client.stats:
+        result['api_stats'] = client.stats.summary()
+    return result
+
+
+class SessionCache(object):
+    """Session tokens shared between module runs, one owner-only file per vCenter host and user."""
+
+    def __init__(self, cache_dir, ttl=1500):
+        """Constructor."""
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.ttl = ttl
+
+    def path(self, hostname, username):
+        key = hashlib.sha256(f"{hostname}/{username}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, hostname, username):
+        try:
+            with open(self.path(hostname, username)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('expires_at', 0) <= time.time():
+            self.remove(hostname, username)
+            return None
+        return entry.get('session_id')
+
+    def put(self, hostname, username, session_id):
+        # vCenter expires idle sessions, so every use pushes the expiry forward
+        entry = {'session_id': session_id, 'expires_at': time.time() + self.ttl}
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path(hostname, username))
+        except (IOError, OSError):
+            pass
+
+    def remove(self, hostname, username):
+        try:
+            os.remove(self.path(hostname, username))
+        except OSError:
+            pass
+
+
+class VCenterClient(object):
+    def __init__(self, hostname, username, password, port=443, validate_certs=False, flavour=API,
+                 connect_timeout=10, request_timeout=300, pool_size=10, max_concurrency=8,
+                 retries=3, session_cache=None, logout_on_close=False, stats=None):
+        """Constructor."""
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.port = port or 443
+        self.flavour = flavour
+        self.timeout = (connect_timeout, request_timeout)
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.session_cache = session_cache
+        self.logout_on_close = logout_on_close or not session_cache
+        self.session_id = None
+        self.stats = stats
+
+        # One keep-alive pool per module run instead of a TLS handshake per call
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, max_concurrency))
+        self.http.mount('https://', adapter)
+        self.http.verify = validate_certs
+
+    @classmethod
+    def from_module(cls, module, flavour=API, **overrides):
+        """Build a client from module params; overrides that are not None replace the params of the same name."""
+        params = dict(module.params)
+        params.update((key, value) for key, value in overrides.items() if value is not None)
+        session_cache = None
+        if params.get('session_cache'):
+            session_cache = SessionCache(params['session_cache_dir'], ttl=params['session_cache_ttl'])
+        client = cls(
+            params['hostname'],
+            params['username'],
+            params['password'],
+            port=params.get('port'),
+            validate_certs=params.get('validate_certs'),
+            flavour=flavour,
+            connect_timeout=params.get('connect_timeout') or 10,
+            request_timeout=params.get('request_timeout') or 300,
+            pool_size=params.get('pool_size') or 10,
+            max_concurrency=params.get('max_concurrency') or 8,
+            retries=params.get('retries', 3),
+            session_cache=session_cache,
+            logout_on_close=params.get('logout'),
+            stats=ApiStats.from_module(module),
+        )
+        # exit_json and fail_json both end in sys.exit, which runs this
+        atexit.register(client.close)
+        return client
+
+    def url(self, path):
+        return f"https://{self.hostname}:{self.port}{path}"
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        # Per request, because requests lets REQUESTS_CA_BUNDLE override a session-level verify=False
+        kwargs.setdefault('verify', self.http.verify)
+        if not self.stats:
+            return self.http.request(method.upper(), self.url(path), **kwargs)
+
+        started = time.monotonic()
+        try:
+            response = self.http.request(method.upper(), self.url(path), **kwargs)
+        except requests.RequestException as e:
+            self.stats.record(self.hostname, method, path, type(e).__name__, time.monotonic() - started)
+            raise
+        body = response.request.body or b''
+        self.stats.record(self.hostname, method, path, response.status_code, time.monotonic() - started,
+                          len(body), len(response.content))
+        return response
+
+    def request_with_retry(self, method, path, **kwargs):
+        """Like request, retrying connection errors and transient statuses with exponential backoff.
+
+        The response carries the number of attempts it took, since a retried
+        call may be answering for an earlier attempt that already went through.
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self.request(method, path, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+            else:
+                if response.status_code not in TRANSIENT_STATUS_CODES or attempt >= self.retries:
+                    response.attempts = attempt + 1
+                    return response
+            time.sleep(min(2 ** attempt, 30))
+            attempt += 1
+
+    def call(self, method, path, retry=False, **kwargs):
+        """Request and decode the JSON body; retry=True is for reads, which are safe to repeat."""
+        response = (self.request_with_retry if retry else self.request)(method, path, **kwargs)
+        response.raise_for_status()
+        return response.json() if response.text else None
+
+    def _value(self, data):
+        if self.flavour == REST:
+            return data.get('value') if data else None
+        return data
+
+    def session_path(self):
+        if self.flavour == REST:
+            return '/rest/com/vmware/cis/session'
+        return '/api/session'
+
+    def session_valid(self, session_id):
+        headers = {SESSION_HEADER: session_id}
+        if self.flavour == REST:
+            response = self.request('post', f"{self.session_path()}?~action=get", headers=headers)
+        else:
+            response = self.request('get', self.session_path(), headers=headers)
+        return response.ok
+
+    def login(self):
+        if self.session_cache:
+            session_id = self.session_cache.get(self.hostname, self.username)
+            if session_id and self.session_valid(session_id):
+                self.session_id = session_id
+                self.http.headers[SESSION_HEADER] = session_id
+                self.session_cache.put(self.hostname, self.username, session_id)
+                return session_id
+
+        self.session_id = self._value(self.call('post', self.session_path(), auth=(self.username, self.password)))
+        self.http.headers[SESSION_HEADER] = self.session_id
+        if self.session_cache:
+            self.session_cache.put(self.hostname, self.username, self.session_id)
+        return self.session_id
+
+    def logout(self):
+        if self.session_id:
+            try:
+                self.request('delete', self.session_path())
+            except requests.RequestException:
+                pass
+        if self.session_cache:
+            self.session_cache.remove(self.hostname, self.username)
+        self.session_id = None
+        self.http.headers.pop(SESSION_HEADER, None)
+
+    def close(self):
+        """Release the connection pool, ending the vCenter session unless it is cached for reuse."""
+        if self.session_id and self.logout_on_close:
+            self.logout()
+        self.http.close()
+
+    def find_library(self, name, library_type=None):
+        spec = {'name': name}
+        if library_type:
+            spec['type'] = library_type
+        if self.flavour == REST:
+            data = self.call('post', '/rest/com/vmware/content/library?~action=find', retry=True, json={'spec': spec})
+        else:
+            data = self.call('post', '/api/content/library?action=find', retry=True, json=spec)
+        return [library_id.replace('"', '') for library_id in self._value(data) or []]
+
+    def get_library(self, library_id):
+        if self.flavour == REST:
+            return self._value(self.call('get', f"/rest/com/vmware/content/library/id:{library_id}", retry=True))
+        return self.call('get', f"/api/content/library/{library_id}", retry=True)
+
+    def item_path(self, item_id):
+        if self.flavour == REST:
+            return f"/rest/com/vmware/content/library/item/id:{item_id}"
+        return f"/api/content/library/item/{item_id}"
+
+    def list_library_items(self, library_id):
+        if self.flavour == REST:
+            path = f"/rest/com/vmware/content/library/item?library_id={library_id}"
+        else:
+            path = f"/api/content/library/item?library_id={library_id}"
+        return [item.replace('"', '') for item in self._value(self.call('get', path, retry=True)) or [] if item]
+
+    def find_library_items(self, library_id, name):
+        spec = {'library_id': library_id, 'name': name}
+        if self.flavour == REST:
+            data = self.call('post', '/rest/com/vmware/content/library/item?~action=find', retry=True, json={'spec': spec})
+        else:
+            data = self.call('post', '/api/content/library/item?action=find', retry=True, json=spec)
+        return self._value(data) or []
+
+    def get_library_item(self, item_id):
+        return self._value(self.call('get', self.item_path(item_id), retry=True))
+
+    def get_library_items(self, item_ids):
+        """Fetch each item once, max_concurrency at a time, in the order of item_ids."""
+        return bounded_map(self.get_library_item, item_ids, self.max_concurrency)
+
+    def iter_library_items(self, item_ids):
+        """Yield (item_id, item) pairs in the order of item_ids, fetching lazily."""
+        return zip(item_ids, bounded_imap(self.get_library_item, item_ids, self.max_concurrency))
+
+    def update_library_item(self, item_id, spec):
+        if self.flavour == REST:
+            return self.request('patch', self.item_path(item_id), json={'update_spec': spec})
+        return self.request('patch', self.item_path(item_id), json=spec)
+
+    def delete_library_item(self, item_id):
+        return self.request_with_retry('delete', self.item_path(item_id))
+
+    @staticmethod
+    def deleted(response):
+        """Whether a delete went through; a 404 on a retry means an earlier attempt removed the item."""
+        return response.status_code in (200, 204) or (response.status_code == 404 and response.attempts > 1)
+
+    def delete_library_items(self, item_ids):
+        """Delete items max_concurrency at a time and report the outcome of every one."""
+        def delete(item_id):
+            try:
+                response = self.delete_library_item(item_id)
+            except requests.RequestException as e:
+                return {'id': item_id, 'status': 'failed', 'msg': str(e)}
+            if self.deleted(response):
+                return {'id': item_id, 'status': 'deleted'}
+            return {'id': item_id, 'status': 'failed', 'status_code': response.status_code, 'msg': response.text}
+
+        return bounded_map(delete, item_ids, self.max_concurrency)
+
+    def long_timeout(self, read_timeout=None):
+        """Timeout for calls that answer only once vCenter has finished the job; None waits as long as it takes."""
+        return (self.timeout[0], read_timeout)
+
+    def copy_library_item(self, item_id, spec, task=False, read_timeout=None):
+        """Copy an item; with task=True vCenter answers with a task id to follow through wait_for_task.
+
+        Without a task the response only comes once the copy is done, so
+        request_timeout does not apply; read_timeout bounds the wait instead.
+        """
+        if self.flavour == REST:
+            return self.request('post', f"{self.item_path(item_id)}?~action=copy", json={'destination_create_spec': spec},
+                                timeout=self.long_timeout(read_timeout))
+        path = f"{self.item_path(item_id)}?action=copy"
+        if task:
+            return self.request('post', f"{path}&vmw-task=true", json=spec)
+        return self.request('post', path, json=spec, timeout=self.long_timeout(read_timeout))
+
+    def get_task(self, task_id):
+        return self.call('get', f"/api/cis/tasks/{task_id}", retry=True)
+
+    def wait_for_task(self, task_id, poll_interval=5, timeout=3600):
+        deadline = time.monotonic() + timeout
+        while True:
+            task = self.get_task(task_id) or {}
+            if task.get('status') in ('SUCCEEDED', 'FAILED') or time.monotonic() >= deadline:
+                return task
+            time.sleep(poll_interval)
+
+    def find_vms(self, names):
+        """VM summaries for one name or a list of names, in a single request."""
+        names = [names] if isinstance(names, str) else list(names)
+        if self.flavour == REST:
+            return self._value(self.call('get', '/rest/vcenter/vm', retry=True, params={'filter.names': names})) or []
+        return self.call('get', '/api/vcenter/vm', retry=True, params={'names': names}) or []
+
+    def create_ovf_library_item(self, payload, read_timeout=None):
+        """Capture a VM as an OVF template; vCenter answers when the export is done, often minutes later."""
+        timeout = self.long_timeout(read_timeout)
+        if self.flavour == REST:
+            return self._value(self.call('post', '/rest/com/vmware/vcenter/ovf/library-item', json=payload, timeout=timeout))
+        return self.call('post', '/api/vcenter/ovf/library-item', json=payload, timeout=timeout)
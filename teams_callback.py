@@ -1,12 +1,396 @@
 from ansible.plugins.callback import CallbackBase
 from ansible.utils.display import Display
-from jinja2 import Environment, BaseLoader
+from jinja2 import Environment, BaseLoader, meta
+from collections import deque
+from collections.abc import Mapping
+from email.utils import parsedate_to_datetime
 import requests
+import csv
 import os
 import json
+import queue
+import threading
+import time
+
+DOCUMENTATION = '''
+    name: teams_callback
+    type: notification
+    short_description: Sends playbook results to Microsoft Teams
+    description:
+      - Posts a MessageCard per host to a Teams webhook when the playbook finishes.
+      - Cards are delivered by a background thread so a slow webhook can't hold the playbook.
+    requirements:
+      - whitelisting in configuration
+    options:
+      template_path:
+        description: Jinja2 template rendered into the per-host MessageCard; compiled once when the callback loads.
+        type: path
+        env:
+          - name: TEAMS_TEMPLATE_PATH
+        ini:
+          - section: callback_teams
+            key: template_path
+      dump_vars:
+        description: Print extra vars, play vars and the whole inventory's hostvars at -v when a play starts.
+        type: bool
+        default: false
+        env:
+          - name: TEAMS_DUMP_VARS
+        ini:
+          - section: callback_teams
+            key: dump_vars
+      webhook_url:
+        description: Webhook the cards are posted to.
+        default: http://eda.togher.com:5000
+        env:
+          - name: TEAMS_WEBHOOK_URL
+        ini:
+          - section: callback_teams
+            key: webhook_url
+      connect_timeout:
+        description: Seconds to wait for the webhook connection.
+        type: float
+        default: 5
+        env:
+          - name: TEAMS_CONNECT_TIMEOUT
+        ini:
+          - section: callback_teams
+            key: connect_timeout
+      read_timeout:
+        description: Seconds to wait for the webhook response.
+        type: float
+        default: 15
+        env:
+          - name: TEAMS_READ_TIMEOUT
+        ini:
+          - section: callback_teams
+            key: read_timeout
+      flush_timeout:
+        description:
+          - Seconds the end of the playbook waits for queued cards before spooling them for the next run.
+          - The wait stretches to the time O(rate_limit) needs for the cards still queued, but only while
+            cards keep being delivered; it ends once this many seconds pass without a successful delivery.
+        type: float
+        default: 30
+        env:
+          - name: TEAMS_FLUSH_TIMEOUT
+        ini:
+          - section: callback_teams
+            key: flush_timeout
+      digest:
+        description:
+          - Send one summary card, grouping hosts by status, instead of one card per host.
+          - The card is split in several when it would exceed O(max_card_size).
+        type: bool
+        default: false
+        env:
+          - name: TEAMS_DIGEST
+        ini:
+          - section: callback_teams
+            key: digest
+      digest_max_hosts:
+        description: Hosts listed per status in the digest card; the rest are only counted.
+        type: int
+        default: 50
+        env:
+          - name: TEAMS_DIGEST_MAX_HOSTS
+        ini:
+          - section: callback_teams
+            key: digest_max_hosts
+      max_card_size:
+        description: Largest digest card, in bytes of JSON, before it is split.
+        type: int
+        default: 24000
+        env:
+          - name: TEAMS_MAX_CARD_SIZE
+        ini:
+          - section: callback_teams
+            key: max_card_size
+      rate_limit:
+        description: Messages per second sent to the webhook, averaged by a token bucket.
+        type: float
+        default: 2
+        env:
+          - name: TEAMS_RATE_LIMIT
+        ini:
+          - section: callback_teams
+            key: rate_limit
+      rate_burst:
+        description: Messages that may go out back to back before O(rate_limit) applies.
+        type: int
+        default: 4
+        env:
+          - name: TEAMS_RATE_BURST
+        ini:
+          - section: callback_teams
+            key: rate_burst
+      max_retries:
+        description: Retries for throttled (429), server-error or unreachable deliveries, with exponential backoff.
+        type: int
+        default: 4
+        env:
+          - name: TEAMS_MAX_RETRIES
+        ini:
+          - section: callback_teams
+            key: max_retries
+      spool_path:
+        description:
+          - File that keeps messages which could not be delivered; they are replayed when the callback next loads.
+        type: path
+        default: ~/.ansible/teams_callback_spool.jsonl
+        env:
+          - name: TEAMS_SPOOL_PATH
+        ini:
+          - section: callback_teams
+            key: spool_path
+      max_spool_messages:
+        description: Oldest spooled messages are dropped beyond this many.
+        type: int
+        default: 500
+        env:
+          - name: TEAMS_MAX_SPOOL_MESSAGES
+        ini:
+          - section: callback_teams
+            key: max_spool_messages
+      stream_events:
+        description:
+          - Report task failures and unreachable hosts while the playbook runs, not only at the end.
+          - Events are gathered over a window and sent as one card per window.
+        type: bool
+        default: false
+        env:
+          - name: TEAMS_STREAM_EVENTS
+        ini:
+          - section: callback_teams
+            key: stream_events
+      event_window:
+        description: Seconds of events gathered into one card.
+        type: float
+        default: 60
+        env:
+          - name: TEAMS_EVENT_WINDOW
+        ini:
+          - section: callback_teams
+            key: event_window
+      event_window_size:
+        description: Events that close a window early.
+        type: int
+        default: 50
+        env:
+          - name: TEAMS_EVENT_WINDOW_SIZE
+        ini:
+          - section: callback_teams
+            key: event_window_size
+      event_buffer_size:
+        description: Events kept per window; older ones are only counted once it is full.
+        type: int
+        default: 200
+        env:
+          - name: TEAMS_EVENT_BUFFER_SIZE
+        ini:
+          - section: callback_teams
+            key: event_buffer_size
+      profile:
+        description:
+          - Time every task and every host's run of it, and list the slowest in the summary.
+          - In digest mode the timings are added to the digest card, otherwise they are sent as a card of their own.
+        type: bool
+        default: false
+        env:
+          - name: TEAMS_PROFILE
+        ini:
+          - section: callback_teams
+            key: profile
+      profile_top:
+        description: How many of the slowest tasks and hosts the summary lists.
+        type: int
+        default: 5
+        env:
+          - name: TEAMS_PROFILE_TOP
+        ini:
+          - section: callback_teams
+            key: profile_top
+      profile_report:
+        description:
+          - File the full timings are written to at the end of the playbook, for comparing runs.
+          - Nothing is written when unset.
+        type: path
+        env:
+          - name: TEAMS_PROFILE_REPORT
+        ini:
+          - section: callback_teams
+            key: profile_report
+      profile_report_format:
+        description: Format of I(profile_report).
+        type: str
+        choices: [json, csv]
+        default: json
+        env:
+          - name: TEAMS_PROFILE_REPORT_FORMAT
+        ini:
+          - section: callback_teams
+            key: profile_report_format
+'''
 
 display = Display()
 
+# Queue marker telling the delivery thread to stop
+_STOP = object()
+
+# Digest groups, worst first; each host lands in the first one that applies
+HOST_STATUSES = ('unreachable', 'failed', 'changed', 'ok')
+
+
+class TokenBucket(object):
+    """Rate limiter for the delivery thread; pause() holds every send back, e.g. for Retry-After."""
+
+    def __init__(self, rate, capacity):
+        """Constructor."""
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.resume_at = 0
+
+    def pause(self, seconds):
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    def delay(self):
+        """Seconds to wait before the next send, taking the token if none."""
+        now = time.monotonic()
+        if now < self.resume_at:
+            return self.resume_at - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+def retry_after_seconds(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class LazyVars(Mapping):
+    """Mapping that runs its loader on first access, so unused variables are never built."""
+
+    def __init__(self, loader):
+        """Constructor."""
+        self._loader = loader
+        self._vars = None
+
+    def _resolve(self):
+        if self._vars is None:
+            self._vars = self._loader()
+        return self._vars
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+    def __iter__(self):
+        return iter(self._resolve())
+
+    def __len__(self):
+        return len(self._resolve())
+
+    def __repr__(self):
+        return repr(self._resolve())
+
+
+class TaskProfiler(object):
+    """Monotonic timings of each task and of each host's run of it, in playbook order.
+
+    A task runs from its start until the next task starts, so it includes
+    waiting for its slowest host. Offsets are seconds since the profiler was
+    created, which keeps reports from different runs comparable.
+    """
+
+    REPORT_FIELDS = ('kind', 'task', 'host', 'start', 'duration')
+
+    def __init__(self):
+        """Constructor."""
+        self.started = time.monotonic()
+        self.tasks = {}
+        self.current = None
+        self.running = {}
+        self.host_runs = []
+        self.host_totals = {}
+
+    def end_task(self, now):
+        if self.current is not None:
+            timing = self.tasks[self.current]
+            timing['duration'] += now - timing['resumed']
+            self.current = None
+
+    def task_start(self, task):
+        now = time.monotonic()
+        self.end_task(now)
+        self.current = task._uuid
+        # Handlers and included loops can start the same task again; keep adding to it
+        timing = self.tasks.setdefault(task._uuid, {'task': task.get_name(), 'start': now - self.started, 'duration': 0.0})
+        timing['resumed'] = now
+
+    def host_start(self, host, task):
+        self.running[(host.get_name(), task._uuid)] = time.monotonic()
+
+    def host_end(self, result):
+        host = result._host.get_name()
+        started = self.running.pop((host, result._task._uuid), None)
+        if started is None:
+            return
+        duration = time.monotonic() - started
+        self.host_runs.append({'kind': 'host', 'task': result._task.get_name(), 'host': host,
+                               'start': started - self.started, 'duration': duration})
+        self.host_totals[host] = self.host_totals.get(host, 0.0) + duration
+
+    def finish(self):
+        self.end_task(time.monotonic())
+
+    def slowest_tasks(self, count):
+        return sorted(((timing['task'], timing['duration']) for timing in self.tasks.values()),
+                      key=lambda pair: pair[1], reverse=True)[:count]
+
+    def slowest_hosts(self, count):
+        return sorted(self.host_totals.items(), key=lambda pair: pair[1], reverse=True)[:count]
+
+    def rows(self):
+        tasks = [{'kind': 'task', 'task': timing['task'], 'host': '', 'start': timing['start'],
+                  'duration': timing['duration']} for timing in self.tasks.values()]
+        return [dict(row, start=round(row['start'], 3), duration=round(row['duration'], 3))
+                for row in tasks + self.host_runs]
+
+    def write_report(self, path, report_format='json'):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', newline='') as f:
+            if report_format == 'csv':
+                writer = csv.DictWriter(f, fieldnames=self.REPORT_FIELDS)
+                writer.writeheader()
+                writer.writerows(self.rows())
+            else:
+                json.dump({'duration': round(time.monotonic() - self.started, 3), 'timings': self.rows()}, f, indent=2)
+        os.replace(tmp_path, path)
+
+
+def host_status(summary):
+    if summary['unreachable']:
+        return 'unreachable'
+    if summary['failures']:
+        return 'failed'
+    if summary['changed']:
+        return 'changed'
+    return 'ok'
+
+
 class CallbackModule(CallbackBase):
     CALLBACK_VERSION = 2.0
     CALLBACK_TYPE = 'notification'
@@ -18,47 +402,427 @@ class CallbackModule(CallbackBase):
         self.teams_webhook_url = 'http://eda.togher.com:5000'
         self.jinja2_template_path = os.path.join(os.path.dirname(__file__), '../templates/teams_message.j2')
         self.host_vars = None
+        self.extra_vars = None
+        self.play_vars = None
+        self.dump_vars = False
+        self.template = None
+        self.template_variables = frozenset()
+        self.timeout = (5, 15)
+        self.flush_timeout = 30
+        self.digest = False
+        self.digest_max_hosts = 50
+        self.max_card_size = 24000
+        self.max_retries = 4
+        self.spool_path = os.path.expanduser('~/.ansible/teams_callback_spool.jsonl')
+        self.max_spool_messages = 500
+        self.bucket = TokenBucket(2, 4)
+        self.stream_events = False
+        self.event_window = 60
+        self.event_window_size = 50
+        self.events = deque(maxlen=200)
+        self.window_started = None
+        self.window_count = 0
+        self.profiler = None
+        self.profile_top = 5
+        self.profile_report = None
+        self.profile_report_format = 'json'
+
+        # Delivery runs on a daemon thread over one keep-alive session
+        self.http = requests.Session()
+        self.http.headers['Content-Type'] = 'application/json'
+        self.outbox = queue.Queue()
+        self.delivery_results = []
+        self.last_delivered = 0
+        self.stopping = threading.Event()
+        self.spool_lock = threading.Lock()
+        self.worker = threading.Thread(target=self.deliver_loop, name='teams_callback', daemon=True)
+        self.worker.start()
+
+    def set_options(self, task_keys=None, var_options=None, direct=None):
+        super(CallbackModule, self).set_options(task_keys=task_keys, var_options=var_options, direct=direct)
+        self.teams_webhook_url = self.get_option('webhook_url')
+        self.timeout = (self.get_option('connect_timeout'), self.get_option('read_timeout'))
+        self.flush_timeout = self.get_option('flush_timeout')
+        self.digest = self.get_option('digest')
+        self.digest_max_hosts = self.get_option('digest_max_hosts')
+        self.max_card_size = self.get_option('max_card_size')
+        self.dump_vars = self.get_option('dump_vars')
+        self.jinja2_template_path = self.get_option('template_path') or self.jinja2_template_path
+        self.max_retries = self.get_option('max_retries')
+        self.spool_path = self.get_option('spool_path')
+        self.max_spool_messages = self.get_option('max_spool_messages')
+        self.stream_events = self.get_option('stream_events')
+        self.event_window = self.get_option('event_window')
+        self.event_window_size = self.get_option('event_window_size')
+        self.events = deque(maxlen=self.get_option('event_buffer_size'))
+        self.bucket = TokenBucket(self.get_option('rate_limit'), self.get_option('rate_burst'))
+        if self.get_option('profile'):
+            self.profiler = TaskProfiler()
+        self.profile_top = self.get_option('profile_top')
+        self.profile_report = self.get_option('profile_report')
+        self.profile_report_format = self.get_option('profile_report_format')
+        self.replay_spool()
+        try:
+            self.load_template()
+        except (IOError, OSError) as e:
+            self._display.warning(f'Could not load Teams template {self.jinja2_template_path}: {e}')
+
+    def load_template(self):
+        """Compile the card template once and note which variables it reads."""
+        with open(self.jinja2_template_path) as f:
+            source = f.read()
+        j2_env = Environment(loader=BaseLoader())
+        self.template = j2_env.from_string(source)
+        self.template_variables = frozenset(meta.find_undeclared_variables(j2_env.parse(source)))
+
+    def render_context(self, **values):
+        # Only hand the template what it references; hostvars and play_vars stay unbuilt otherwise
+        available = dict(values, hostvars=self.host_vars, extra_vars=self.extra_vars, play_vars=self.play_vars)
+        return {name: available[name] for name in self.template_variables if name in available}
+
+    def deliver_loop(self):
+        while True:
+            payload = self.outbox.get()
+            if payload is _STOP:
+                return
+            if self.stopping.is_set():
+                self.abandon(payload)
+                return
+            self.delivery_results.append(self.deliver(payload))
+
+    def abandon(self, payload):
+        """Spool payload and everything queued behind it once flush has given up on the webhook."""
+        # Only the delivery thread spools, so a message is never both sent and kept for replay
+        pending = [payload]
+        while True:
+            try:
+                payload = self.outbox.get_nowait()
+            except queue.Empty:
+                break
+            if payload is not _STOP:
+                pending.append(payload)
+        self.spool_messages(pending)
+        self.delivery_results.extend({'status': 'abandoned', 'duration': 0, 'spooled': True} for _ in pending)
+
+    def wait(self, seconds):
+        """Sleep on the delivery thread; False once flush has given up, so the caller spools instead."""
+        return not self.stopping.wait(seconds)
+
+    def deliver(self, payload):
+        attempt = 0
+        while True:
+            delay = self.bucket.delay()
+            while delay:
+                if not self.wait(delay):
+                    return self.spool(payload, {'status': 'abandoned', 'duration': 0})
+                delay = self.bucket.delay()
+
+            result = self.send(payload)
+            if result['status'] == 200:
+                self.last_delivered = time.monotonic()
+            transient = not isinstance(result['status'], int) or result['status'] == 429 or result['status'] >= 500
+            if result['status'] == 200 or not transient:
+                return result
+            if attempt >= self.max_retries or self.stopping.is_set():
+                return self.spool(payload, result)
+            # Honour the webhook's Retry-After, otherwise back off exponentially
+            backoff = result.get('retry_after')
+            self.bucket.pause(backoff if backoff is not None else min(2 ** attempt, 60))
+            attempt += 1
+
+    def send(self, payload):
+        started = time.monotonic()
+        retry_after = None
+        try:
+            response = self.http.post(self.teams_webhook_url, json=payload, timeout=self.timeout)
+            status = response.status_code
+            retry_after = retry_after_seconds(response.headers.get('Retry-After'))
+        except requests.RequestException as e:
+            status = f"error: {e}"
+        return {'status': status, 'duration': round(time.monotonic() - started, 3), 'retry_after': retry_after}
+
+    def spool(self, payload, result=None):
+        """Keep an undelivered message for the next run and return its delivery result marked spooled."""
+        self.spool_messages([payload])
+        return dict(result or {}, spooled=True)
+
+    def spool_messages(self, payloads):
+        """Append to the spool in one write, dropping the oldest beyond max_spool_messages."""
+        with self.spool_lock:
+            try:
+                messages = self.read_spool()
+                messages.extend(payloads)
+                os.makedirs(os.path.dirname(self.spool_path) or '.', exist_ok=True)
+                tmp_path = f"{self.spool_path}.tmp"
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w') as f:
+                    for message in messages[-self.max_spool_messages:]:
+                        f.write(json.dumps(message) + '\n')
+                os.replace(tmp_path, self.spool_path)
+            except (IOError, OSError) as e:
+                display.v(f"Could not spool Teams message: {e}")
+
+    def read_spool(self):
+        try:
+            with open(self.spool_path) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except (IOError, OSError, ValueError):
+            return []
+
+    def replay_spool(self):
+        with self.spool_lock:
+            messages = self.read_spool()
+            if not messages:
+                return
+            try:
+                os.remove(self.spool_path)
+            except OSError:
+                pass
+        display.v(f"Replaying {len(messages)} spooled Teams message(s)")
+        for payload in messages:
+            self.outbox.put(payload)
 
     def post_to_teams(self, payload):
         display.v("Post to Teams Running")
-        headers = {'Content-Type': 'application/json'}
-        response = requests.post(self.teams_webhook_url, json=payload, headers=headers)
-        if response.status_code != 200:
-            self._display.warning('Failed to send message to Microsoft Teams')
-            
+        self.outbox.put(payload)
+
+    def wait_budget(self):
+        """flush_timeout plus what the rate limit needs for the backlog, so large runs are sent, not spooled."""
+        backlog = max(self.outbox.qsize() - self.bucket.capacity, 0)
+        return self.flush_timeout + backlog / self.bucket.rate
+
+    def flush(self):
+        """Wait for queued cards to go out; whatever is left past the budget goes to the spool.
+
+        The budget only holds while the webhook keeps taking cards: flush gives
+        up once flush_timeout passes without a successful delivery.
+        """
+        started = time.monotonic()
+        deadline = started + self.wait_budget()
+        self.outbox.put(_STOP)
+        while self.worker.is_alive():
+            progress = max(started, self.last_delivered)
+            remaining = min(deadline, progress + self.flush_timeout) - time.monotonic()
+            if remaining <= 0:
+                break
+            self.worker.join(remaining)
+        if self.worker.is_alive():
+            budget = time.monotonic() - started
+            # The delivery thread spools what it has not sent; a post already on the wire may still finish
+            self.stopping.set()
+            self.worker.join(sum(self.timeout))
+            spooled = sum(1 for result in self.delivery_results if result['status'] == 'abandoned')
+            self._display.warning(f'Gave up waiting for Microsoft Teams after {budget:.0f}s, '
+                                  f'{spooled} message(s) spooled for the next run')
+
+        for result in self.delivery_results:
+            display.v(f"Teams delivery: status {result['status']} in {result['duration']}s"
+                      f"{' (spooled)' if result.get('spooled') else ''}")
+            if result['status'] not in (200, 'abandoned'):
+                self._display.warning('Failed to send message to Microsoft Teams')
+        self.http.close()
+
     def v2_playbook_on_play_start(self, play):
         display.v("v2_playbook_on_play_start method is being called")
         self.play = play
         # get variable manager and retrieve extra-vars
         vm = play.get_variable_manager()
         self.extra_vars = vm.extra_vars
-        self.play_vars = vm.get_vars(self.play)
+        self.play_vars = LazyVars(lambda: vm.get_vars(play))
         # The following is used to retrieve variables defined under group_vars or host_vars.
         # If the same variable is defined under both with the same scope, the one defined under host_vars takes precedence.
-        self.host_vars = vm.get_vars()['hostvars']
-        display.v(f"extra_vars: {self.extra_vars}")
-        display.v(f"play_vars: {self.play_vars}")
-        display.v(f"host_vars: {self.host_vars}")
+        self.host_vars = LazyVars(lambda: vm.get_vars()['hostvars'])
+        if self.dump_vars:
+            display.v(f"extra_vars: {self.extra_vars}")
+            display.v(f"play_vars: {self.play_vars}")
+            display.v(f"host_vars: {self.host_vars}")
+
+    def build_digest_cards(self, stats):
+        """One MessageCard for the whole run, or a few if the host lists push it over max_card_size."""
+        hosts_by_status = {status: [] for status in HOST_STATUSES}
+        totals = {'ok': 0, 'changed': 0, 'failures': 0, 'unreachable': 0, 'skipped': 0}
+        for current_host in sorted(stats.processed.keys()):
+            summary = stats.summarize(current_host)
+            for key in totals:
+                totals[key] += summary.get(key, 0)
+            hosts_by_status[host_status(summary)].append(current_host)
+
+        failed = hosts_by_status['failed'] or hosts_by_status['unreachable']
+        header = {
+            "activityTitle": "Ansible Playbook Summary",
+            "activitySubtitle": f"{len(stats.processed)} hosts",
+            "facts": [{"name": key.capitalize(), "value": str(value)} for key, value in totals.items()],
+            "markdown": True,
+        }
+
+        sections = self.profile_sections()
+        for status in HOST_STATUSES:
+            hosts = hosts_by_status[status]
+            if not hosts:
+                continue
+            listed = hosts[:self.digest_max_hosts]
+            text = ', '.join(listed)
+            if len(hosts) > len(listed):
+                text += f" and {len(hosts) - len(listed)} more"
+            # Keep any single section well inside one card
+            chunk_size = max(self.max_card_size // 2, 1)
+            for start in range(0, len(text), chunk_size):
+                sections.append({"activityTitle": f"{status.capitalize()} ({len(hosts)})",
+                                 "text": text[start:start + chunk_size]})
+
+        cards = []
+        card = self.digest_card([header], failed)
+        for section in sections:
+            candidate = self.digest_card(card['sections'] + [section], failed)
+            if len(card['sections']) > 1 and len(json.dumps(candidate)) > self.max_card_size:
+                cards.append(card)
+                candidate = self.digest_card([dict(header, activitySubtitle="continued"), section], failed)
+            card = candidate
+        cards.append(card)
+        return cards
+
+    def digest_card(self, sections, failed):
+        return {
+            "@type": "MessageCard",
+            "@context": "http://schema.org/extensions",
+            "summary": "Ansible Notification",
+            "themeColor": "D70000" if failed else "0076D7",
+            "sections": sections,
+        }
+
+    def record_event(self, kind, result):
+        if not self.stream_events:
+            return
+        if self.window_started is None:
+            self.window_started = time.monotonic()
+        # The ring buffer keeps a failure storm to event_buffer_size entries; the rest are counted
+        self.events.append({
+            'kind': kind,
+            'host': result._host.get_name(),
+            'task': result._task.get_name(),
+            'msg': str(result._result.get('msg', ''))[:300],
+        })
+        self.window_count += 1
+        self.check_event_window()
+
+    def check_event_window(self, force=False):
+        if self.window_started is None:
+            return
+        elapsed = time.monotonic() - self.window_started
+        if force or elapsed >= self.event_window or self.window_count >= self.event_window_size:
+            self.post_to_teams(self.build_event_card(elapsed))
+            self.events.clear()
+            self.window_started = None
+            self.window_count = 0
+
+    def build_event_card(self, elapsed):
+        facts = [{"name": f"{event['kind'].upper()} {event['host']}",
+                  "value": f"{event['task']}: {event['msg']}" if event['msg'] else event['task']}
+                 for event in self.events]
+        dropped = self.window_count - len(self.events)
+        if dropped:
+            facts.append({"name": "Not listed", "value": f"{dropped} more event(s)"})
+        return {
+            "@type": "MessageCard",
+            "@context": "http://schema.org/extensions",
+            "summary": "Ansible Notification",
+            "themeColor": "D70000",
+            "sections": [{
+                "activityTitle": "Ansible Task Failures",
+                "activitySubtitle": f"{self.window_count} event(s) in the last {int(elapsed)}s",
+                "facts": facts,
+                "markdown": True,
+            }],
+        }
+
+    def profile_sections(self):
+        if not self.profiler:
+            return []
+        self.profiler.finish()
+        sections = []
+        for title, timings in (("Slowest tasks", self.profiler.slowest_tasks(self.profile_top)),
+                               ("Slowest hosts", self.profiler.slowest_hosts(self.profile_top))):
+            if timings:
+                sections.append({"activityTitle": title,
+                                 "facts": [{"name": name, "value": f"{duration:.1f}s"} for name, duration in timings]})
+        return sections
+
+    def write_profile_report(self):
+        if not self.profiler or not self.profile_report:
+            return
+        self.profiler.finish()
+        try:
+            self.profiler.write_report(self.profile_report, self.profile_report_format)
+        except (IOError, OSError) as e:
+            self._display.warning(f'Could not write timing report {self.profile_report}: {e}')
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        if self.profiler:
+            self.profiler.task_start(task)
+        # Task boundaries are where a quiet window gets closed
+        self.check_event_window()
+
+    def v2_playbook_on_handler_task_start(self, task):
+        if self.profiler:
+            self.profiler.task_start(task)
+
+    def v2_runner_on_start(self, host, task):
+        if self.profiler:
+            self.profiler.host_start(host, task)
+
+    def v2_runner_on_ok(self, result):
+        if self.profiler:
+            self.profiler.host_end(result)
+
+    def v2_runner_on_skipped(self, result):
+        if self.profiler:
+            self.profiler.host_end(result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        if self.profiler:
+            self.profiler.host_end(result)
+        if not ignore_errors:
+            self.record_event('failed', result)
+
+    def v2_runner_on_unreachable(self, result):
+        if self.profiler:
+            self.profiler.host_end(result)
+        self.record_event('unreachable', result)
 
     def v2_playbook_on_stats(self, stats):
         display.v("Playbook on Stats Function Running")
-        
-        j2_env = Environment(loader=BaseLoader())
-        template = j2_env.from_string(open(self.jinja2_template_path).read())
+        self.check_event_window(force=True)
+        self.write_profile_report()
+
+        if self.digest:
+            for payload in self.build_digest_cards(stats):
+                display.v(f"Payload: {payload}")
+                self.post_to_teams(payload)
+            self.flush()
+            return
+
+        if self.template is None:
+            self.load_template()
 
         hosts = sorted(stats.processed.keys())
         for current_host in hosts:
-            summary = stats.summarize(current_host)            
+            summary = stats.summarize(current_host)
             try:
-                rendered_template = template.render({
-                    'host': current_host,
-                    'hostvars': self.host_vars,
-                    'task_name': 'Playbook Summary',
-                    'status': 'OK' if summary['failures'] == 0 else 'FAILED'
-                })
+                rendered_template = self.template.render(self.render_context(
+                    host=current_host,
+                    task_name='Playbook Summary',
+                    status='OK' if summary['failures'] == 0 else 'FAILED',
+                ))
                 payload = json.loads(rendered_template)
             except Exception as e:
                 display.v(f"Templating error: {e}")
-                return  # Exit the function, or handle the error in another way
+                break  # Stop rendering, but still deliver what is already queued
             display.v(f"Payload: {payload}")
             self.post_to_teams(payload)
+
+        profile_sections = self.profile_sections()
+        if profile_sections:
+            self.post_to_teams(self.digest_card(
+                [{"activityTitle": "Ansible Playbook Timing", "markdown": True}] + profile_sections, False))
+
+        self.flush()
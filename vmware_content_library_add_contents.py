@@ -1,22 +1,22 @@
 #!/usr/bin/python
 
-import json
-import requests
 import uuid
-import urllib3
 import time
+import requests
 from collections import defaultdict
 from ansible.module_utils.basic import *
-from ansible.module_utils.vmware_rest_client import VmwareRestClient
+from ansible.module_utils.vcenter_client import VCenterClient, vcenter_client_argument_spec, bounded_map, REST, run_stats
+from ansible.module_utils.content_library_inventory import LibraryInventory
+from ansible.module_utils.template_notes import parse_notes, PUBLISHED, UNPUBLISHED, RETIRED
+from ansible.module_utils.template_retention import RetentionPolicy, version_key
 from ansible.module_utils._text import to_native
 from datetime import datetime
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-class VMwareContentLibraryManager(VmwareRestClient):
+class VMwareContentLibraryManager(object):
     def __init__(self, module):
         """Constructor."""
-        super(VMwareContentLibraryManager, self).__init__(module)
+        self.module = module
+        self.params = module.params
         self.hostname = self.params.get('hostname')
         self.content_library = self.params.get('content_library')
         self.vm_name = self.params.get('vm_name')
@@ -27,89 +27,102 @@ class VMwareContentLibraryManager(VmwareRestClient):
         self.vm_notes = self.params.get('vm_notes')
         self.port = self.params.get('port')
         self.new_template_name = self.params.get('new_template_name')
+        self.vms = self.params.get('vms') or [{'vm_name': self.vm_name, 'new_template_name': self.new_template_name}]
+        self.capture_concurrency = self.params.get('capture_concurrency')
 
         # Session management
-        self.session = self.get_vcenter_session()
+        self.client = VCenterClient.from_module(module, flavour=REST)
+        self.session = self.api_call(self.get_vcenter_session)
 
-    def api_call(self, url, method='get', headers=None, **kwargs):
-        response = getattr(requests, method)(url, headers=headers, **kwargs)
-        response.raise_for_status()
-        return response.json() if response.text else None
+    def api_call(self, func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except requests.RequestException as e:
+            self.module.fail_json(msg=f"Failed to make API call: {str(e)}", **run_stats(self.client))
 
     def get_vcenter_session(self):
-        url = f"https://{self.hostname}/rest/com/vmware/cis/session"
-        response = requests.post(url, auth=(self.username, self.password), verify=self.validate_certs)
-        response.raise_for_status()
-        return response.json()
+        return self.client.login()
 
-    def get_vm_id(self):
-        url = f"https://{self.hostname}/rest/vcenter/vm?filter.names={self.vm_name}"
-        headers = {'vmware-api-session-id': self.session['value']}
-        data = self.api_call(url, headers=headers, verify=self.validate_certs)
-        return data['value'][0]['vm'] if data else None
+    def get_vm_ids(self):
+        # One lookup for the whole batch instead of one per VM
+        data = self.client.find_vms([spec['vm_name'] for spec in self.vms])
+        return {vm['name']: vm['vm'] for vm in data}
 
     def get_lib_id(self):
-        url = f"https://{self.hostname}/rest/com/vmware/content/library?~action=find"
-        headers = {'vmware-api-session-id': self.session['value']}
-        params = {'spec': {'name': self.content_library, 'type': 'LOCAL'}}
-        data = self.api_call(url, method='post', headers=headers, json=params, verify=self.validate_certs)
-        return data['value'] if data else None
+        data = self.client.find_library(self.content_library, 'LOCAL')
+        return data if data else None
 
-    def check_content_library_state(self):
-        lib_id = self.get_lib_id()
-        return 'present' if lib_id else 'absent'
-  
-    def check_vm_state(self):
-        lib_id = self.get_vm_id()
-        return 'present' if lib_id else 'absent'
-
-    def add_vm_to_content_library(self):
-        vm_id = self.get_vm_id()
-        lib_id = self.get_lib_id()
-
-        url = f"https://{self.hostname}/rest/com/vmware/vcenter/ovf/library-item"
-        headers = {
-            'vmware-api-session-id': self.session['value'],
-            'Content-Type': 'application/json'
-        }
+    def capture_vm(self, spec, vm_id, lib_id):
+        """Capture one VM as an OVF template, reporting the outcome instead of failing the module."""
         payload = {
             "create_spec": {
-                "name": f"{self.new_template_name}"
+                "name": f"{spec['new_template_name']}"
             },
             "source": {
                 "id": f"{vm_id}",
                 "type": "VirtualMachine"
             },
             "target": {
-                "library_id": f"{lib_id[0]}"
+                "library_id": f"{lib_id}"
             }
         }
-        response = self.api_call(url, method='post', headers=headers, json=payload, verify=self.validate_certs)
-        if not response or response.get('succeeded') is False:
-            self.module.fail_json(msg=f"Failed to add VM: {self.vm_name} to Content Library: {self.content_library}.")
-        
-        self.remove_excess_templates(lib_id=lib_id[0])
-        self.publish_template(lib_id=lib_id[0])
-
-    def get_all_template_ids(self, lib_id):
-        url = f"https://{self.hostname}/rest/com/vmware/content/library/item?library_id={lib_id}"
-        headers = {'vmware-api-session-id': self.session['value']}
-        data = self.api_call(url, method='get', headers=headers, verify=self.validate_certs)
-        if data:
-            templates = []
-            for item in data['value']:
-                if item:
-                    template_id = item.replace('"', '')
-                    template_name = self.get_template_name(template_id)
-                    template_notes = self.get_template_notes(template_id)
-                    vm_name = template_name.split('_')[0] if '_' in template_name else template_name
-                    templates.append((template_id, vm_name, template_name, template_notes))
-            return templates
+        result = {'vm_name': spec['vm_name'], 'template_name': spec['new_template_name']}
+        started = time.monotonic()
+        try:
+            response = self.client.create_ovf_library_item(payload)
+        except requests.RequestException as e:
+            result.update(status='failed', msg=to_native(e))
         else:
-            return None
-            
-    def publish_template(self, lib_id):
-        template_data = self.get_all_template_ids(lib_id)
+            if not response or response.get('succeeded') is False:
+                result.update(status='failed',
+                              msg=f"Failed to add VM: {spec['vm_name']} to Content Library: {self.content_library}.")
+            else:
+                result.update(status='succeeded', id=(response.get('resource_id') or {}).get('id'))
+        result['duration'] = round(time.monotonic() - started, 3)
+        return result
+
+    def add_vms_to_content_library(self, lib_id, vm_ids):
+        # The create call returns once vCenter has finished the export, so each worker waits on its own capture
+        captures = bounded_map(
+            lambda spec: self.capture_vm(spec, vm_ids[spec['vm_name']], lib_id),
+            self.vms,
+            self.capture_concurrency,
+        )
+        failed = [capture for capture in captures if capture['status'] == 'failed']
+        if failed:
+            # Retention counts on the new templates being there, so it waits for a clean batch
+            self.module.fail_json(
+                msg=f"Failed to capture {len(failed)} of {len(captures)} VMs.",
+                changed=len(failed) < len(captures),
+                captures=captures,
+                **run_stats(self.client)
+            )
+
+        # Retention and publishing both work from this one listing
+        try:
+            inventory = LibraryInventory.load(self.client, lib_id)
+            self.remove_excess_templates(lib_id, inventory, captures)
+            self.publish_template(lib_id, inventory, captures)
+        except requests.RequestException as e:
+            self.fail_after_captures(captures, f"Failed to make API call: {to_native(e)}")
+        return captures
+
+    def fail_after_captures(self, captures, msg, **result):
+        # The new templates are in the library by now, so the failure still reports them as a change
+        self.module.fail_json(msg=msg, changed=True, captures=captures, **result, **run_stats(self.client))
+
+    def get_all_template_ids(self, inventory):
+        templates = []
+        for template_id, item in inventory:
+            template_name = item.get('name', '')
+            template_notes = item.get('description', '')
+            vm_name = template_name.split('_')[0] if '_' in template_name else template_name
+            templates.append((template_id, vm_name, template_name, template_notes))
+        return templates
+
+    def publish_template(self, lib_id, inventory, captures):
+        vm_names = {capture['vm_name'] for capture in captures}
+        template_data = self.get_all_template_ids(inventory)
         if template_data:
             templates_by_vm = defaultdict(list)
             for template_id, vm_name, template_name, template_notes in template_data:
@@ -117,75 +130,91 @@ class VMwareContentLibraryManager(VmwareRestClient):
             for vm_name, templates in templates_by_vm.items():
                 templates.sort(key=lambda x: x[1], reverse=True)
                 for template_id, template_name, template_notes in templates:
-                    if vm_name == self.vm_name:  # Only update notes if VM names match
+                    if vm_name in vm_names:  # Only update notes of the captured VMs
                         if template_notes:
-                            notes=json.loads(template_notes.replace("'",'"'))
-                            if notes['published'] and notes['published'] == 'False':
-                                notes['published'] = 'True'
-                            elif notes['published'] and notes['published'] == 'True':
-                                notes['published'] = 'Retired'
-                            url = f"https://{self.hostname}/rest/com/vmware/content/library/item/id:{template_id}"
-                            headers = {'vmware-api-session-id': self.session['value']}
-                            payload = { 'update_spec': { 'description': f'{notes}' }}
-                            response = requests.patch(url, headers=headers, json=payload, verify=self.validate_certs)
+                            notes = parse_notes(template_notes)
+                            if notes.published == UNPUBLISHED:
+                                notes = notes.replace(published=PUBLISHED)
+                            elif notes.published == PUBLISHED:
+                                notes = notes.replace(published=RETIRED)
+                            response = self.client.update_library_item(template_id, {'description': notes.dumps()})
                             if response.status_code != 200:
-                                self.module.fail_json(msg=f"Failed to update published status of template: {template_name} with ID: {template_id[0]}")
-
-    def get_template_name(self, template_id):
-        url = f"https://{self.hostname}/rest/com/vmware/content/library/item/id:{template_id}"
-        headers = {'vmware-api-session-id': self.session['value']}
-        data = self.api_call(url, headers=headers, verify=self.validate_certs)
-        return data['value'].get('name', '') if data else ''
-        
-    def get_template_notes(self, template_id):
-        url = f"https://{self.hostname}/rest/com/vmware/content/library/item/id:{template_id}"
-        headers = {'vmware-api-session-id': self.session['value']}
-        data = self.api_call(url, headers=headers, verify=self.validate_certs)
-        return data['value'].get('description', '') if data else ''
-
-    def remove_excess_templates(self, lib_id):
-        template_data = self.get_all_template_ids(lib_id)
+                                self.fail_after_captures(
+                                    captures,
+                                    f"Failed to update published status of template: {template_name} with ID: {template_id}",
+                                )
+
+    def remove_excess_templates(self, lib_id, inventory, captures):
+        template_data = self.get_all_template_ids(inventory)
         if template_data:
-            templates_by_vm = defaultdict(list)
-            for template_id, vm_name, template_name, template_notes in template_data:
-                templates_by_vm[vm_name].append((template_id, template_name))
-            for vm_name, templates in templates_by_vm.items():
-                templates.sort(key=lambda x: x[1], reverse=True)
-                if len(templates) > 2:
-                    for template_id, template_name in templates[2:]:
-                        url = f"https://{self.hostname}/rest/com/vmware/content/library/item/id:{template_id}"
-                        headers = {'vmware-api-session-id': self.session['value']}
-                        response = requests.delete(url, headers=headers, verify=self.validate_certs)
-                        if response.status_code != 200:
-                            self.module.fail_json(msg=f"Failed to delete template with ID: {template_id}")
+            # Keep the two newest templates of each VM, comparing the numbers in their names numerically
+            policy = RetentionPolicy(
+                group_key=lambda template: template[1],
+                keep=2,
+                order_key=lambda template: version_key(template[2]),
+            )
+            excess = policy.select(template_data)
+            results = [dict(result, name=template[2], reason=reason) for (template, reason), result
+                       in zip(excess, self.client.delete_library_items([template[0] for template, _ in excess]))]
+            for result in results:
+                if result['status'] == 'deleted':
+                    inventory.remove(result['id'])
+            failed = [result for result in results if result['status'] == 'failed']
+            if failed:
+                self.fail_after_captures(
+                    captures,
+                    f"Failed to delete {len(failed)} of {len(results)} excess templates.",
+                    removed=results,
+                )
 
     def process_state(self):
-        if self.check_content_library_state() == 'absent':
-            self.module.fail_json(msg=f"Content Library '{self.content_library}' does not exist.")
-        if self.check_vm_state() == 'absent':
-            self.module.fail_json(msg=f"Virtual Machine Source '{self.vm_name}' does not exist")
-        self.add_vm_to_content_library()
+        lib_id = self.get_lib_id()
+        if not lib_id:
+            self.module.fail_json(msg=f"Content Library '{self.content_library}' does not exist.",
+                                  **run_stats(self.client))
+        vm_ids = self.get_vm_ids()
+        missing = [spec['vm_name'] for spec in self.vms if spec['vm_name'] not in vm_ids]
+        if missing:
+            self.module.fail_json(msg=f"Virtual Machine Source '{', '.join(missing)}' does not exist",
+                                  **run_stats(self.client))
+        return self.add_vms_to_content_library(lib_id[0], vm_ids)
 
 
 def main():
-    module = AnsibleModule(
-        argument_spec=dict(
-            hostname=dict(type='str', required=True),
-            content_library=dict(type='str', required=True),
-            vm_name=dict(type='str', required=True),
-            validate_certs=dict(type='bool', default=True),
-            username=dict(type='str', required=True),
-            password=dict(type='str', required=True, no_log=True),
-            esxi_host=dict(type='str', required=True),
-            vm_notes=dict(type='str', default=''),
-            port=dict(type='int', default=443),
-            new_template_name=dict(type='str', required=True)
+    argument_spec = dict(
+        hostname=dict(type='str', required=True),
+        content_library=dict(type='str', required=True),
+        vm_name=dict(type='str'),
+        validate_certs=dict(type='bool', default=True),
+        username=dict(type='str', required=True),
+        password=dict(type='str', required=True, no_log=True),
+        esxi_host=dict(type='str', required=True),
+        vm_notes=dict(type='str', default=''),
+        port=dict(type='int', default=443),
+        new_template_name=dict(type='str'),
+        vms=dict(
+            type='list',
+            elements='dict',
+            options=dict(
+                vm_name=dict(type='str', required=True),
+                new_template_name=dict(type='str', required=True),
+            ),
         ),
+        capture_concurrency=dict(type='int', default=4),
+    )
+    argument_spec.update(vcenter_client_argument_spec())
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        required_together=[['vm_name', 'new_template_name']],
+        required_one_of=[['vm_name', 'vms']],
+        mutually_exclusive=[['vm_name', 'vms']],
     )
 
     vmware_content_library_manager = VMwareContentLibraryManager(module)
-    vmware_content_library_manager.process_state()
-    module.exit_json(changed=False)
+    captures = vmware_content_library_manager.api_call(vmware_content_library_manager.process_state)
+    result = run_stats(vmware_content_library_manager.client)
+    module.exit_json(changed=bool(captures), captures=captures, **result)
 
 
 if __name__ == '__main__':
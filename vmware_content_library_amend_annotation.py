@@ -1,15 +1,16 @@
-import json
-import requests
-import urllib3
 from ansible.module_utils.basic import *
-from ansible.module_utils.vmware_rest_client import VmwareRestClient
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+import requests
+import time
+from ansible.module_utils.vcenter_client import VCenterClient, vcenter_client_argument_spec, bounded_map, TRANSIENT_STATUS_CODES, run_stats
+from ansible.module_utils.content_library_inventory import LibraryInventory
+from ansible.module_utils.template_notes import parse_notes, PUBLISHED, UNPUBLISHED, RETIRED
+from ansible.module_utils.template_retention import RetentionPolicy
 
-class VMwareContentLibraryManager(VmwareRestClient):
+class VMwareContentLibraryManager(object):
     def __init__(self, module):
         """Constructor."""
-        super(VMwareContentLibraryManager, self).__init__(module)
+        self.module = module
+        self.params = module.params
         self.hostname = self.params.get('hostname')
         self.content_library = self.params.get('content_library')
         self.validate_certs = self.params.get('validate_certs')
@@ -18,121 +19,126 @@ class VMwareContentLibraryManager(VmwareRestClient):
         self.port = self.params.get('port')
 
         # Session management
-        self.session = self.get_vcenter_session()
+        self.client = VCenterClient.from_module(module)
+        self.session = self.api_call(self.get_vcenter_session)
+
+    def api_call(self, func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except requests.RequestException as e:
+            self.module.fail_json(msg=f"Failed to make API call: {str(e)}", **run_stats(self.client))
 
     def get_vcenter_session(self):
-        url = f"https://{self.hostname}/api/session"
-        response = requests.post(url, auth=(self.username, self.password), verify=self.validate_certs)
-        response.raise_for_status()
-        return response.json()
-        
-    def get_template_name(self, template_id):
-        url = f"https://{self.hostname}/api/content/library/item/{template_id}"
-        headers = {'vmware-api-session-id': self.session}
-        data = self.api_call(url, headers=headers, verify=self.validate_certs)
-        return data.get('name', '') if data else ''
+        return self.client.login()
         
-    def get_all_template_ids(self, lib_id):
-        url = f"https://{self.hostname}/api/content/library/item?library_id={lib_id}"
-        headers = {'vmware-api-session-id': self.session}
-        data = self.api_call(url, method='get', headers=headers, verify=self.validate_certs)
-        if data:
-            templates = []
-            for item in data:
-                if item:
-                    template_id = item.replace('"', '')
-                    template_name = self.get_template_name(template_id)
-                    template_notes = self.get_template_notes(template_id)
-                    vm_name = template_name.split('_')[0] if '_' in template_name else template_name
-                    templates.append((template_id, vm_name, template_name, template_notes))
-            return templates
-        else:
-            return None
-
-    def get_template_notes(self, template_id):
-        url = f"https://{self.hostname}/api/content/library/item/{template_id}"
-        headers = {'vmware-api-session-id': self.session}
-        data = self.api_call(url, headers=headers, verify=self.validate_certs)
-        return data.get('description', '') if data else ''
-
     def check_content_library_state(self):
         lib_id = self.get_lib_id()
         return 'present' if lib_id else 'absent'
 
-    def api_call(self, url, method='get', headers=None, **kwargs):
-        response = getattr(requests, method)(url, headers=headers, **kwargs)
-        response.raise_for_status()
-        return response.json() if response.text else None
-
     def get_lib_id(self):
-        url = f"https://{self.hostname}/api/content/library?action=find"
-        headers = {'vmware-api-session-id': self.session}
-        params = {'name': self.content_library, 'type': 'LOCAL'}
-        data = self.api_call(url, method='post', headers=headers, json=params, verify=self.validate_certs)
-        return data[0].replace('"','') if data else None
+        data = self.client.find_library(self.content_library, 'LOCAL')
+        return data[0] if data else None
 
     def update_templates_in_library(self, lib_id):
-        template_data = self.get_all_template_ids(lib_id)
+        inventory = LibraryInventory.load(self.client, lib_id)
         templates_to_update = []  # To store templates that need to be updated
-        os_versions_count_false = {}  # To track the count of templates with 'published' False for each operatingSystemVersion
-
-        # First loop through and find templates with 'published': 'False' for each operatingSystemVersion
-        if template_data:
-            for template_id, _, _, template_notes in template_data:
-                if template_notes:
-                    notes = json.loads(template_notes.replace("'", '"'))
-                    os_version = notes.get('operatingSystemVersion')
-                    if os_version and notes.get('published') == 'False':
-                        os_versions_count_false[os_version] = os_versions_count_false.get(os_version, 0) + 1
-                        notes['published'] = 'True'
-                        templates_to_update.append((template_id, notes))
-
-            # Now loop through and retire templates with 'published': 'True' only if there's a corresponding 'False'
-            for template_id, _, _, template_notes in template_data:
-                if template_notes:
-                    notes = json.loads(template_notes.replace("'", '"'))
-                    os_version = notes.get('operatingSystemVersion')
-                    if os_version and notes.get('published') == 'True' and os_versions_count_false.get(os_version):
-                        notes['published'] = 'Retired'
-                        templates_to_update.append((template_id, notes))
-
-        return templates_to_update
-
-    def update_template_notes_with_id(self, template_id, notes):
-        url = f"https://{self.hostname}/api/content/library/item/{template_id}"
-        headers = {'vmware-api-session-id': self.session}
-        payload = {'description': f'{notes}'}
-        response = requests.patch(url, headers=headers, json=payload, verify=self.validate_certs)
-        if response.status_code != 204:
-            self.module.fail_json(msg=f"Failed to update published status of template with ID: {template_id}")
+
+        # Group once by operatingSystemVersion and published state, the same split retention uses
+        policy = RetentionPolicy(
+            group_key=lambda template: template[2].os_version or None,
+            state_key=lambda template: template[2].published,
+            order_key=lambda template: template[1].get('creation_time') or '',
+        )
+        parsed = [(template_id, item, parse_notes(item.get('description', ''))) for template_id, item in inventory]
+        for os_version, states in policy.partition(parsed).items():
+            # Only a version with 'False' templates waiting moves: they are published and the current ones retired
+            if not states.get(UNPUBLISHED):
+                continue
+            for template_id, item, notes in states[UNPUBLISHED]:
+                templates_to_update.append(self.plan_update(template_id, item, notes, PUBLISHED))
+            for template_id, item, notes in states.get(PUBLISHED, []):
+                templates_to_update.append(self.plan_update(template_id, item, notes, RETIRED))
+
+        # Notes that already serialize to what is stored need no PATCH
+        return [update for update in templates_to_update
+                if update['description'] != inventory.get(update['id']).get('description', '')]
+
+    def plan_update(self, template_id, item, notes, published):
+        return {
+            'id': template_id,
+            'name': item.get('name', ''),
+            'from': notes.published,
+            'to': published,
+            'metadata_version': item.get('metadata_version'),
+            'description': notes.replace(published=published).dumps(),
+        }
+
+    def update_template(self, update):
+        """PATCH one template's notes, redoing the flip on fresh state if the item moved since the listing.
+
+        vCenter has no conditional PATCH, so the item is re-read right before
+        writing and its metadata_version compared with the one listed. A
+        template someone else has already moved on is reported as a conflict
+        rather than overwritten.
+        """
+        result = {'id': update['id'], 'name': update['name'], 'published': update['to']}
+        for attempt in range(self.client.retries + 1):
+            try:
+                item = self.client.get_library_item(update['id']) or {}
+                if item.get('metadata_version') != update['metadata_version']:
+                    notes = parse_notes(item.get('description', ''))
+                    if notes.published == update['to']:
+                        return dict(result, status='unchanged')
+                    if notes.published != update['from']:
+                        return dict(result, status='conflict', msg=f"published changed to {notes.published!r} meanwhile")
+                    update = dict(update, metadata_version=item.get('metadata_version'),
+                                  description=notes.replace(published=update['to']).dumps())
+                response = self.client.update_library_item(update['id'], {'description': update['description']})
+            except requests.RequestException as e:
+                return dict(result, status='failed', msg=str(e))
+            if response.status_code == 204:
+                return dict(result, status='updated')
+            if response.status_code not in TRANSIENT_STATUS_CODES:
+                return dict(result, status='failed', status_code=response.status_code, msg=response.text)
+            time.sleep(min(2 ** attempt, 30))
+        return dict(result, status='failed', status_code=response.status_code, msg=response.text)
 
     def process_state(self):
         if self.check_content_library_state() == 'absent':
-            self.module.fail_json(msg=f"Content Library '{self.content_library}' does not exist.")
+            self.module.fail_json(msg=f"Content Library '{self.content_library}' does not exist.",
+                                  **run_stats(self.client))
         # Get library id
         lib_id = self.get_lib_id()
         # Get all templates to update
         templates_to_update = self.update_templates_in_library(lib_id)
-        # Update each template
-        for template_id, notes in templates_to_update:
-            self.update_template_notes_with_id(template_id, json.dumps(notes)) # Make sure to pass JSON string
-        return
+        # Each update touches a different item, so they go out side by side
+        return bounded_map(self.update_template, templates_to_update, self.client.max_concurrency)
 
 def main():
-    module = AnsibleModule(
-        argument_spec=dict(
-            hostname=dict(type='str', required=True),
-            content_library=dict(type='str', required=True),
-            validate_certs=dict(type='bool', default=True),
-            username=dict(type='str', required=True),
-            password=dict(type='str', required=True, no_log=True),
-            port=dict(type='int', default=443)
-        ),
+    argument_spec = dict(
+        hostname=dict(type='str', required=True),
+        content_library=dict(type='str', required=True),
+        validate_certs=dict(type='bool', default=True),
+        username=dict(type='str', required=True),
+        password=dict(type='str', required=True, no_log=True),
+        port=dict(type='int', default=443)
     )
+    argument_spec.update(vcenter_client_argument_spec())
+
+    module = AnsibleModule(argument_spec=argument_spec)
 
     vmware_content_library_template_manager = VMwareContentLibraryManager(module)
-    vmware_content_library_template_manager.process_state()
-    module.exit_json(changed=True)
+    updates = vmware_content_library_template_manager.api_call(vmware_content_library_template_manager.process_state)
+    result = run_stats(vmware_content_library_template_manager.client)
+    changed = any(update['status'] == 'updated' for update in updates)
+    for update in updates:
+        if update['status'] == 'conflict':
+            module.warn(f"Template {update['name']} was left alone: {update['msg']}")
+    failed = [update for update in updates if update['status'] == 'failed']
+    if failed:
+        module.fail_json(msg=f"Failed to update published status of {len(failed)} of {len(updates)} templates.",
+                         changed=changed, updates=updates, **result)
+    module.exit_json(changed=changed, updates=updates, **result)
 
 if __name__ == '__main__':
     main()
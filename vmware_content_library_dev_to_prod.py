@@ -1,31 +1,41 @@
 #!/usr/bin/python
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.vmware_rest_client import VmwareRestClient
+from ansible.module_utils.vcenter_client import VCenterClient, vcenter_client_argument_spec, bounded_map, run_stats
+from ansible.module_utils.content_library_inventory import LibraryInventory
+from ansible.module_utils.template_notes import parse_notes, PUBLISHED, UNPUBLISHED, RETIRED
+from ansible.module_utils.template_retention import RetentionPolicy
 import requests
-import json
 import time
 from collections import defaultdict
 from datetime import datetime
-import urllib3
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-
-class VMwareContentLibraryManager(VmwareRestClient):
+class VMwareContentLibraryManager(object):
     def __init__(self, module):
         """Constructor."""
-        super(VMwareContentLibraryManager, self).__init__(module)
+        self.module = module
+        self.params = module.params
         self.hostname = self.params.get('hostname')
         self.source_library = self.params.get('source_library')
         self.destination_library = self.params.get('destination_library')
+        self.destinations = self.params.get('destinations')
+        self.destination_concurrency = self.params.get('destination_concurrency')
         self.validate_certs = self.params.get('validate_certs')
         self.username = self.params.get('username')
         self.password = self.params.get('password')
         self.port = self.params.get('port')
+        self.copy_concurrency = self.params.get('copy_concurrency')
+        self.track_tasks = self.params.get('track_tasks')
+        self.task_poll_interval = self.params.get('task_poll_interval')
+        self.copy_timeout = self.params.get('copy_timeout')
 
         # Session management
-        self.session = self.get_vcenter_session()
+        self.client = VCenterClient.from_module(module)
+        self.session = self.api_call(self.get_vcenter_session)
+
+        # Library snapshots keyed by (vCenter hostname, library id)
+        self.inventories = {}
 
         # Variables to manage template prefix count
         self.source_prefix_count = defaultdict(int)
@@ -35,191 +45,375 @@ class VMwareContentLibraryManager(VmwareRestClient):
         self.source_os_version_count = defaultdict(int)
         self.destination_os_version_count = defaultdict(int)
 
-    def api_call(self, url, method='get', headers=None, **kwargs):
-        response = getattr(requests, method)(url, headers=headers, **kwargs)
-        response.raise_for_status()
-        return response.json() if response.text else None
+    def api_call(self, func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except requests.RequestException as e:
+            self.module.fail_json(msg=f"Failed to make API call: {str(e)}", **run_stats(self.client))
 
     def get_vcenter_session(self):
-        url = f"https://{self.hostname}/api/session"
-        response = requests.post(url, auth=(self.username, self.password), verify=self.validate_certs)
-        response.raise_for_status()
-        return response.json()
+        return self.client.login()
 
     def get_template_attr(self, template_id, attr):
-        url = f"https://{self.hostname}/api/content/library/item/{template_id}"
-        headers = {'vmware-api-session-id': self.session}
-        data = self.api_call(url, headers=headers, verify=self.validate_certs)
+        data = self.client.get_library_item(template_id)
         return data.get(attr, '') if data else ''
 
     def get_source_library_id(self):
-        url = f"https://{self.hostname}/api/content/library?action=find"
-        headers = {'vmware-api-session-id': self.session}
-        params = {'name': self.source_library, 'type': 'LOCAL'}
-        data = self.api_call(url, method='post', headers=headers, json=params, verify=self.validate_certs)
-        return data[0].replace('"', '') if data else None
+        data = self.client.find_library(self.source_library, 'LOCAL')
+        return data[0] if data else None
 
     def get_destination_library_id(self):
-        url = f"https://{self.hostname}/api/content/library?action=find"
-        headers = {'vmware-api-session-id': self.session}
-        params = {'name': self.destination_library, 'type': 'LOCAL'}
-        data = self.api_call(url, method='post', headers=headers, json=params, verify=self.validate_certs)
-        return data[0].replace('"', '') if data else None
+        data = self.client.find_library(self.destination_library, 'LOCAL')
+        return data[0] if data else None
 
     def check_content_library_state(self, library_id):
         return 'present' if library_id else 'absent'
 
-    def remove_unpublished_templates(self, library_id):
-        templates = self.get_all_template_ids(library_id)
-        for template_id, _, _, template_notes in templates:
-            if self.check_template_published(template_notes) == 'False':
-                self.delete_template_from_library(template_id, library_id)
+    def get_inventory(self, library_id, client=None):
+        # One listing per library per run; deletes and copies update the snapshot in place
+        client = client or self.client
+        key = (client.hostname, library_id)
+        if key not in self.inventories:
+            self.inventories[key] = LibraryInventory.load(client, library_id)
+        return self.inventories[key]
 
-    def get_all_template_ids(self, library_id):
-        url = f"https://{self.hostname}/api/content/library/item?library_id={library_id}"
-        headers = {'vmware-api-session-id': self.session}
-        data = self.api_call(url, method='get', headers=headers, verify=self.validate_certs)
+    def get_all_template_ids(self, library_id, client=None):
         templates = []
-        if data:
-            for item in data:
-                if item:
-                    template_id = item.replace('"', '')
-                    template_name = self.get_template_attr(template_id, 'name')
-                    template_notes = self.get_template_attr(template_id, 'description')
-                    operating_system_version = None
-                    if template_notes:
-                        notes = json.loads(template_notes.replace("'", '"'))
-                        operating_system_version = notes.get('operatingSystemVersion', None)
-                    templates.append((template_id, operating_system_version, template_name, template_notes))
+        for template_id, item in self.get_inventory(library_id, client):
+            template_name = item.get('name', '')
+            template_notes = item.get('description', '')
+            operating_system_version = parse_notes(template_notes).os_version
+            templates.append((template_id, operating_system_version, template_name, template_notes))
         return templates
 
     def check_template_published(self, template_notes):
-        if template_notes:
-            notes = json.loads(template_notes.replace("'", '"'))
-            return notes.get('published', 'False')
-        return 'False'
-
-    def copy_templates_to_library(self, source_library_id, destination_library_id):
+        return parse_notes(template_notes).published or UNPUBLISHED
+
+    def get_copy_notes(self, template_notes):
+        return parse_notes(template_notes).replace(published=UNPUBLISHED).dumps()
+
+    def plan_unpublished_removals(self, destination_templates):
+        return [template for template in destination_templates
+                if self.check_template_published(template[3]) == 'False']
+
+    def plan_copies(self, source_templates, destination_names):
+        copies = []
+        for template_id, os_version, template_name, template_notes in source_templates:
+            # Only copy templates with 'True' status that the destination doesn't hold yet
+            if self.check_template_published(template_notes) == 'True' and template_name not in destination_names:
+                destination_names.add(template_name)
+                copies.append((template_id, os_version, template_name, template_notes))
+        return copies
+
+    def plan_excess_removals(self, templates, creation_times):
+        """(template, reason) for each template retention drops, newest by creation_time.
+
+        Per operatingSystemVersion the newest 'True' and the newest 'False'
+        template are kept, and 'Retired' ones go once a 'False' is waiting.
+        Copies not made yet have no id and count as newer than anything listed.
+        """
+        policy = RetentionPolicy(
+            group_key=lambda template: template[1] or None,
+            state_key=lambda template: self.check_template_published(template[3]),
+            order_key=lambda template: (template[0] is None, creation_times.get(template[0]) or ''),
+            keep={PUBLISHED: 1, UNPUBLISHED: 1, RETIRED: 0},
+            prune_when={RETIRED: UNPUBLISHED},
+        )
+        return policy.select(templates)
+
+    def build_plan(self, source_library_id, destination_library_id, client=None):
+        """Work out every delete and copy of the promotion from one snapshot of each library."""
         source_templates = self.get_all_template_ids(source_library_id)
-        destination_templates = self.get_all_template_ids(destination_library_id)
-
-        if source_templates:
-            for template_id, os_version, template_name, template_notes in source_templates:
-                published_status = self.check_template_published(template_notes)
-                if published_status == 'True':  # Only copy templates with 'True' status
-                    if not any(d_template_name == template_name for _, _, d_template_name, _ in destination_templates):
-                        self.copy_template_to_library(template_id, template_name, destination_library_id)
-
-    def check_template_exists(self, template_id):
-        url = f"https://{self.hostname}/api/content/library/item/{template_id}"
-        headers = {'vmware-api-session-id': self.session}
-        data = self.api_call(url, method='get', headers=headers, verify=self.validate_certs)
-        return bool(data)
-
-    def copy_template_to_library(self, template_id, template_name, destination_library_id):
-        url = f"https://{self.hostname}/api/content/library/item/{template_id}?action=copy"
-        headers = {
-            'vmware-api-session-id': self.session,
-            'Content-Type': 'application/json'
+        destination_templates = self.get_all_template_ids(destination_library_id, client)
+
+        unpublished = self.plan_unpublished_removals(destination_templates)
+        unpublished_ids = {template[0] for template in unpublished}
+        remaining = [template for template in destination_templates if template[0] not in unpublished_ids]
+
+        copies = self.plan_copies(source_templates, {template[2] for template in remaining})
+        # Copies land in the destination as unpublished and newer than the existing items
+        pending = [(None, os_version, template_name, self.get_copy_notes(template_notes))
+                   for _, os_version, template_name, template_notes in copies]
+        creation_times = {template_id: item.get('creation_time')
+                          for template_id, item in self.get_inventory(destination_library_id, client)}
+        excess = self.plan_excess_removals(remaining + pending, creation_times)
+
+        # A copy that retention would delete straight away is not worth making
+        skipped_names = {template[2] for template, _ in excess if template[0] is None}
+        copies = [template for template in copies if template[2] not in skipped_names]
+        excess = [(template, reason) for template, reason in excess if template[0] is not None]
+
+        return {
+            'remove_unpublished': [self.plan_entry(template) for template in unpublished],
+            'copy': [self.plan_entry(template) for template in copies],
+            'remove_excess': [dict(self.plan_entry(template), reason=reason) for template, reason in excess],
         }
 
-        # Fetch the annotations from the source template
-        annotations = self.get_template_attr(template_id, 'description')
-        if annotations:
-            notes = json.loads(annotations.replace("'", '"'))
-            notes['published'] = 'False'
+    def plan_entry(self, template):
+        template_id, os_version, template_name, _ = template
+        return {'id': template_id, 'name': template_name, 'os_version': os_version}
+
+    def execute_plan(self, plan, source_library_id, destination_library_id, client=None, replica_library_id=None):
+        """Carry out the plan, collecting every outcome instead of stopping at the first failure."""
+        results = {
+            'remove_unpublished': self.remove_templates(plan['remove_unpublished'], destination_library_id, client),
+            'copy': self.copy_templates_to_library(plan['copy'], source_library_id, destination_library_id,
+                                                   client, replica_library_id),
+        }
+        # Retention was planned around the copies landing, so it waits for all of them
+        if any(result['status'] == 'failed' for result in results['copy']):
+            results['remove_excess'] = [dict(entry, status='skipped') for entry in plan['remove_excess']]
         else:
-            notes = {'published': 'False'}
+            results['remove_excess'] = self.remove_templates(plan['remove_excess'], destination_library_id, client)
+        return results
+
+    def copy_templates_to_library(self, copies, source_library_id, destination_library_id, client=None,
+                                  replica_library_id=None):
+        source_inventory = self.get_inventory(source_library_id)
+
+        def copy(entry):
+            annotations = source_inventory.get(entry['id']).get('description', '')
+            return self.copy_template_to_library(entry['id'], entry['name'], destination_library_id, annotations,
+                                                 client, replica_library_id)
+
+        # Each copy is a long OVF transfer on the vCenter side, so several run at once
+        return bounded_map(copy, copies, self.copy_concurrency)
+
+    def start_copy(self, template_id, payload, client=None):
+        """Start a copy and wait for it, returning the new item id."""
+        client = client or self.client
+        if self.track_tasks:
+            response = client.copy_library_item(template_id, payload, task=True)
+            # vCenter builds without task support for copies reject the flag; copy synchronously there
+            if response.status_code not in (400, 404):
+                response.raise_for_status()
+                task = client.wait_for_task(response.json(), self.task_poll_interval, self.copy_timeout)
+                if task.get('status') != 'SUCCEEDED':
+                    raise RuntimeError(f"copy task {task.get('status', 'UNKNOWN')}: {task.get('error')}")
+                return task.get('result')
+
+        response = client.copy_library_item(template_id, payload, read_timeout=self.copy_timeout)
+        response.raise_for_status()
+        if not response.text:
+            raise RuntimeError("Template copy failed.")
+        return response.text.strip().strip('"')
+
+    def resolve_replica_item(self, client, replica_library_id, template_name):
+        # Item copies cannot cross vCenters, so a remote site copies from its own replica of the source library
+        data = client.find_library_items(replica_library_id, template_name)
+        if not data:
+            raise RuntimeError(f"Template '{template_name}' not found in the source library replica.")
+        return data[0]
+
+    def copy_template_to_library(self, template_id, template_name, destination_library_id, annotations=None,
+                                 client=None, replica_library_id=None):
+        client = client or self.client
+        # Fetch the annotations from the source template unless the caller already has them
+        if annotations is None:
+            annotations = self.get_template_attr(template_id, 'description')
+        description = self.get_copy_notes(annotations)
 
         payload = {
             "name": template_name,
             "library_id": destination_library_id,
-            "description": json.dumps(notes)  # Add the modified annotations to the destination template
+            "description": description  # Add the modified annotations to the destination template
         }
 
-        response = requests.post(url, headers=headers, json=payload, verify=self.validate_certs)
-        response_text = response.text
-        if not response_text:
-            self.module.fail_json(msg="Template copy failed.")
+        result = {'id': template_id, 'name': template_name}
+        started = time.monotonic()
+        try:
+            if replica_library_id:
+                template_id = self.resolve_replica_item(client, replica_library_id, template_name)
+            new_id = self.start_copy(template_id, payload, client)
+        except Exception as e:
+            result.update(status='failed', msg=str(e))
         else:
-            return response_text
-
-    def delete_template_from_library(self, template_id, library_id):
-        url = f"https://{self.hostname}/api/content/library/item/{template_id}"
-        headers = {'vmware-api-session-id': self.session}
-        response = requests.delete(url, headers=headers, verify=self.validate_certs)
-        if response.status_code != 204:
-            self.module.fail_json(msg="Failed to delete template.")
-            
-    def remove_excess_templates(self, library_id):
-        # Getting all templates
-        templates = self.get_all_template_ids(library_id)
-
-        # Grouping templates by operatingSystemVersion
-        os_version_templates = defaultdict(lambda: {'True': [], 'False': [], 'Retired': []})
-        for template in templates:
-            template_id, os_version, _, template_notes = template
-            if os_version:
-                notes = json.loads(template_notes.replace("'", '"'))
-                published_status = notes.get('published', 'False')
-                os_version_templates[os_version][published_status].append(template_id)
-
-        # Processing each OS version group
-        for _, template_lists in os_version_templates.items():
-            # Keep the latest 'True' template and remove the others
-            for template_id in template_lists['True'][:-1]:
-                self.delete_template_from_library(template_id, library_id)
-
-            # Keep only the latest 'False' template and remove the others
-            for template_id in template_lists['False'][:-1]:
-                self.delete_template_from_library(template_id, library_id)
-
-            # Remove all 'Retired' templates only if there is at least one 'False' template
-            if template_lists['False']:
-                for template_id in template_lists['Retired']:
-                    self.delete_template_from_library(template_id, library_id)
-
+            result.update(status='succeeded', new_id=new_id)
+            key = (client.hostname, destination_library_id)
+            if key in self.inventories:
+                self.inventories[key].add(new_id, {'name': template_name, 'description': description})
+        result['duration'] = round(time.monotonic() - started, 3)
+        return result
+
+    def remove_templates(self, entries, library_id, client=None):
+        client = client or self.client
+        results = client.delete_library_items([entry['id'] for entry in entries])
+        key = (client.hostname, library_id)
+        if key in self.inventories:
+            for result in results:
+                if result['status'] == 'deleted':
+                    self.inventories[key].remove(result['id'])
+        return [dict(entry, **result) for entry, result in zip(entries, results)]
+
+    def get_target_client(self, target):
+        if target['hostname'] == self.hostname and not target.get('username'):
+            return self.client
+        client = VCenterClient.from_module(
+            self.module,
+            hostname=target['hostname'],
+            username=target.get('username'),
+            password=target.get('password'),
+            port=target.get('port'),
+        )
+        client.login()
+        return client
+
+    def promote_to_target(self, target, source_library_id):
+        """Promote the source library to one destination, returning its outcome instead of failing the module."""
+        outcome = {'hostname': target['hostname'], 'library': target['library']}
+        started = time.monotonic()
+        try:
+            client = self.get_target_client(target)
+            destination = client.find_library(target['library'], 'LOCAL')
+            if not destination:
+                return dict(outcome, status='failed', msg="Destination library not found.")
+            destination_library_id = destination[0]
+
+            replica_library_id = None
+            if client is not self.client:
+                replica = client.find_library(target.get('source_library') or self.source_library)
+                if not replica:
+                    return dict(outcome, status='failed', msg="Source library replica not found.")
+                replica_library_id = replica[0]
+
+            plan = self.build_plan(source_library_id, destination_library_id, client)
+            outcome.update(plan=plan, changed=any(plan.values()))
+            if self.module.check_mode:
+                return dict(outcome, status='planned')
+
+            results = self.execute_plan(plan, source_library_id, destination_library_id, client, replica_library_id)
+            failed = [result for step in results.values() for result in step if result['status'] == 'failed']
+            outcome.update(results=results, status='failed' if failed else 'succeeded')
+            if failed:
+                outcome['msg'] = f"{len(failed)} promotion step(s) failed."
+        except Exception as e:
+            outcome.update(status='failed', msg=str(e))
+        outcome['duration'] = round(time.monotonic() - started, 3)
+        return outcome
+
+    def promote_to_destinations(self, source_library_id):
+        # Read the source once, then let every site work through its own plan at the same time
+        self.get_inventory(source_library_id)
+        outcomes = bounded_map(
+            lambda target: self.promote_to_target(target, source_library_id),
+            self.destinations,
+            self.destination_concurrency,
+        )
+        result = run_stats(self.client)
+        failed = [outcome for outcome in outcomes if outcome['status'] == 'failed']
+        if failed:
+            self.module.fail_json(
+                msg=f"Promotion failed for {len(failed)} of {len(outcomes)} destinations.",
+                source_library=self.source_library,
+                destinations=outcomes,
+                **result
+            )
+        self.module.exit_json(
+            changed=any(outcome.get('changed') for outcome in outcomes),
+            msg="Templates copied successfully.",
+            source_library=self.source_library,
+            destinations=outcomes,
+            **result
+        )
 
     def main(self):
         """Main entry point of the module."""
         source_library_id = self.get_source_library_id()
         source_library_state = self.check_content_library_state(source_library_id)
 
+        if self.destinations:
+            if source_library_state == 'absent':
+                self.module.fail_json(msg="Source library not found.", **run_stats(self.client))
+            self.promote_to_destinations(source_library_id)
+
         destination_library_id = self.get_destination_library_id()
         destination_library_state = self.check_content_library_state(destination_library_id)
 
         if source_library_state == 'absent':
-            self.module.fail_json(msg="Source library not found.")
+            self.module.fail_json(msg="Source library not found.", **run_stats(self.client))
         elif destination_library_state == 'absent':
-            self.module.fail_json(msg="Destination library not found.")
+            self.module.fail_json(msg="Destination library not found.", **run_stats(self.client))
         else:
-            self.remove_unpublished_templates(destination_library_id)
-            self.copy_templates_to_library(source_library_id, destination_library_id)
-            self.remove_excess_templates(destination_library_id)
+            plan = self.build_plan(source_library_id, destination_library_id)
+            changed = any(plan.values())
+
+            if self.module.check_mode:
+                self.module.exit_json(
+                    changed=changed,
+                    msg="Promotion plan computed, no changes made (check mode).",
+                    source_library=self.source_library,
+                    destination_library=self.destination_library,
+                    plan=plan,
+                    **run_stats(self.client)
+                )
+
+            results = self.execute_plan(plan, source_library_id, destination_library_id)
+
+            failed = [result for step in results.values() for result in step if result['status'] == 'failed']
+            if failed:
+                self.module.fail_json(
+                    msg=f"{len(failed)} promotion step(s) failed.",
+                    source_library=self.source_library,
+                    destination_library=self.destination_library,
+                    plan=plan,
+                    results=results,
+                    **run_stats(self.client)
+                )
 
             self.module.exit_json(
+                changed=changed,
                 msg="Templates copied successfully.",
                 source_library=self.source_library,
                 destination_library=self.destination_library,
+                plan=plan,
+                results=results,
+                **run_stats(self.client)
             )
 
 
 def main():
-    argument_spec = VmwareRestClient.vmware_client_argument_spec()
-    argument_spec.update(
+    argument_spec = dict(
+        # Connection options community.vmware modules take, still accepted so existing tasks validate
+        protocol=dict(type='str', default='https', choices=['https', 'http']),
+        proxy_host=dict(type='str'),
+        proxy_port=dict(type='int'),
         hostname=dict(type='str', required=True),
         username=dict(type='str', required=True),
         password=dict(type='str', required=True, no_log=True),
         port=dict(type='int', default=443),
         source_library=dict(type='str', required=True),
-        destination_library=dict(type='str', required=True),
-        validate_certs=dict(type='bool', default=False)
+        destination_library=dict(type='str'),
+        destinations=dict(
+            type='list',
+            elements='dict',
+            options=dict(
+                hostname=dict(type='str', required=True),
+                library=dict(type='str', required=True),
+                source_library=dict(type='str'),
+                username=dict(type='str'),
+                password=dict(type='str', no_log=True),
+                port=dict(type='int'),
+            ),
+        ),
+        destination_concurrency=dict(type='int', default=4),
+        validate_certs=dict(type='bool', default=False),
+        copy_concurrency=dict(type='int', default=4),
+        track_tasks=dict(type='bool', default=True),
+        task_poll_interval=dict(type='int', default=5),
+        copy_timeout=dict(type='int', default=3600),
     )
+    argument_spec.update(vcenter_client_argument_spec())
 
-    module = AnsibleModule(argument_spec=argument_spec)
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        mutually_exclusive=[['destination_library', 'destinations']],
+        required_one_of=[['destination_library', 'destinations']],
+        supports_check_mode=True,
+    )
 
     vmware_content_lib_mgr = VMwareContentLibraryManager(module)
-    vmware_content_lib_mgr.main()
+    # Lookups and planning raise on API errors; execute_plan reports failed steps itself
+    vmware_content_lib_mgr.api_call(vmware_content_lib_mgr.main)
 
 
 if __name__ == '__main__':
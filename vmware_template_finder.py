@@ -1,94 +1,113 @@
 #!/usr/bin/python
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.vmware_rest_client import VmwareRestClient
+from ansible.module_utils.vcenter_client import VCenterClient, vcenter_client_argument_spec, REST, run_stats
+from ansible.module_utils.content_library_inventory import LibraryInventory
+from ansible.module_utils.content_library_cache import InventoryCache, inventory_cache_argument_spec
+from ansible.module_utils.template_notes import parse_notes
 import requests
-import json
-import urllib3
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-class VMwareTemplateFinder(VmwareRestClient):
+class VMwareTemplateFinder(object):
     def __init__(self, module):
         """Constructor."""
-        super(VMwareTemplateFinder, self).__init__(module)
+        self.module = module
+        self.params = module.params
         self.hostname = self.params.get('hostname')
         self.library = self.params.get('library')
         self.os_version = self.params.get('os_version')
+        self.os_versions = self.params.get('os_versions')
+        self.filters = self.params.get('filters') or {}
         self.validate_certs = self.params.get('validate_certs')
         self.username = self.params.get('username')
         self.password = self.params.get('password')
         self.port = self.params.get('port', '443')  # Default port if not specified
+        self.selection = self.params.get('selection')
 
         # Session management
-        self.session = self.get_vcenter_session()
+        self.client = VCenterClient.from_module(module, flavour=REST)
+        self.session = self.api_call(self.get_vcenter_session)
+        self.cache = InventoryCache.from_module(module)
 
-    def api_call(self, url, method='get', headers=None, **kwargs):
+    def api_call(self, func, *args, **kwargs):
         try:
-            response = getattr(requests, method)(url, headers=headers, **kwargs)
-            response.raise_for_status()
-            return response.json() if response.text else None
+            return func(*args, **kwargs)
         except requests.RequestException as e:
-            self.module.fail_json(msg=f"Failed to make API call: {str(e)}")
+            self.module.fail_json(msg=f"Failed to make API call: {str(e)}", **run_stats(self.client, self.cache))
 
     def get_vcenter_session(self):
-        url = f"https://{self.hostname}:{self.port}/rest/com/vmware/cis/session"
-        response = requests.post(url, auth=(self.username, self.password), verify=self.validate_certs)
-        response.raise_for_status()
-        return response.json().get('value')
-
-    def get_template_attrs(self, template_id, *attrs):
-        url = f"https://{self.hostname}:{self.port}/rest/com/vmware/content/library/item/id:{template_id}"
-        headers = {'vmware-api-session-id': self.session}
-        data = self.api_call(url, headers=headers, verify=self.validate_certs)
-        return [data['value'].get(attr, '') for attr in attrs] if data else ['' for _ in attrs]
+        return self.client.login()
 
     def get_library_id(self):
-        url = f"https://{self.hostname}:{self.port}/rest/com/vmware/content/library?~action=find"
-        headers = {'vmware-api-session-id': self.session}
-        params = {'spec': {'name': self.library}}
-        data = self.api_call(url, method='post', headers=headers, json=params, verify=self.validate_certs)
-        return data['value'][0] if data and 'value' in data and data['value'] else None
-
-    def get_all_template_ids(self, library_id):
-        url = f"https://{self.hostname}:{self.port}/rest/com/vmware/content/library/item?library_id={library_id}"
-        headers = {'vmware-api-session-id': self.session}
-        data = self.api_call(url, method='get', headers=headers, verify=self.validate_certs)
-        templates = []
-        if data:
-            for item in data['value']:
-                if item:
-                    template_id = item.replace('"', '')
-                    template_name, template_notes = self.get_template_attrs(template_id, 'name', 'description')
-                    vm_name = template_name.split('_')[0] if '_' in template_name else template_name
-                    templates.append((template_id, vm_name, template_name, template_notes))
-        return templates
+        data = self.api_call(self.client.find_library, self.library)
+        return data[0] if data else None
+
+    def iter_templates(self, library_id):
+        # A cached inventory is already local; otherwise fetch item details only as far as the search gets
+        if self.cache:
+            return iter(LibraryInventory.load(self.client, library_id, self.cache))
+        item_ids = self.client.list_library_items(library_id)
+        return ((template_id, item or {}) for template_id, item in self.client.iter_library_items(item_ids))
+
+    def filters_match(self, notes):
+        return all(str(notes.get(field)) == str(value) for field, value in self.filters.items())
+
+    def build_index(self, library_id, os_versions=None):
+        """Index matching templates by (operatingSystemVersion, published) from one scan of the library."""
+        index = {}
+        wanted = {(os_version, True) for os_version in os_versions} if os_versions is not None else None
+        for template_id, item in self.iter_templates(library_id):
+            notes = parse_notes(item.get('description', ''))
+            if not notes:
+                continue
+            key = (notes.os_version or '', notes.is_published)
+            if (wanted is not None and key not in wanted) or not self.filters_match(notes):
+                continue
+            index.setdefault(key, []).append(item)
+            if self.selection == 'first' and wanted is not None and wanted.issubset(index):
+                break
+        return index
+
+    def pick_template(self, matches):
+        if not matches:
+            return None
+        # Newest creation time wins, with the name breaking ties
+        newest = max(matches, key=lambda item: (item.get('creation_time') or '', item.get('name', '')))
+        return newest.get('name', '')
 
     def find_template(self, library_id):
-        templates = self.get_all_template_ids(library_id)
-        if templates:
-            for template_id, _, template_name, template_notes in templates:
-                if template_notes:
-                    notes = json.loads(template_notes.replace("'", '"'))
-                    published_status = notes.get('published', False)
-                    os_version = notes.get('operatingSystemVersion', '')
-                    if isinstance(published_status, str):
-                        published_status = published_status not in ['False', 'Retired']
-                    if published_status and os_version == self.os_version:
-                        return template_name
-        return None
+        index = self.build_index(library_id, [self.os_version])
+        return self.pick_template(index.get((self.os_version, True)))
+
+    def find_templates(self, library_id):
+        """Map each requested OS version, or every published one matching filters, to a template name."""
+        index = self.build_index(library_id, self.os_versions)
+        os_versions = self.os_versions
+        if os_versions is None:
+            os_versions = sorted(os_version for os_version, published in index if published)
+        return {os_version: self.pick_template(index.get((os_version, True))) for os_version in os_versions}
 
     def execute(self):
         """Execute module functionality."""
         library_id = self.get_library_id()
         if not library_id:
-            self.module.fail_json(msg="Library not found.")
+            self.module.fail_json(msg="Library not found.", **run_stats(self.client, self.cache))
+        elif not self.os_version:
+            templates = self.api_call(self.find_templates, library_id)
+            result = run_stats(self.client, self.cache)
+            self.module.exit_json(
+                changed=False,
+                templates=templates,
+                not_found=[os_version for os_version, template_name in templates.items() if not template_name],
+                **result
+            )
         else:
-            template_name = self.find_template(library_id)
+            template_name = self.api_call(self.find_template, library_id)
+            result = run_stats(self.client, self.cache)
             if template_name:
-                self.module.exit_json(changed=False, template_name=template_name)
+                self.module.exit_json(changed=False, template_name=template_name, **result)
             else:
-                self.module.fail_json(msg="No matching template found.")
+                self.module.fail_json(msg="No matching template found.", **result)
 
 
 def main():
@@ -100,10 +119,21 @@ def main():
         "validate_certs": {"type": "bool", "required": False, "default": False},
         "port": {"type": "str", "required": False, "default": "443"},
         "library": {"type": "str", "required": True},
-        "os_version": {"type": "str", "required": True},
+        "os_version": {"type": "str", "required": False},
+        "os_versions": {"type": "list", "elements": "str", "required": False},
+        "filters": {"type": "dict", "required": False},
+        "selection": {"type": "str", "required": False, "default": "first", "choices": ["first", "newest"]},
     }
 
-    module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=True)
+    argument_spec.update(vcenter_client_argument_spec())
+    argument_spec.update(inventory_cache_argument_spec())
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        mutually_exclusive=[["os_version", "os_versions"]],
+        required_one_of=[["os_version", "os_versions", "filters"]],
+        supports_check_mode=True,
+    )
     template_finder = VMwareTemplateFinder(module)
     template_finder.execute()
 